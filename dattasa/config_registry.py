@@ -0,0 +1,57 @@
+import os
+import threading
+import yaml
+
+
+'''
+Process wide registry of parsed yaml config files (database.yaml, ftpsites.yaml).
+Each file is parsed once and the parsed dictionary is shared by all the factories in data_pipeline and
+file_processor. The file is parsed again only when its modification time or size changes.
+Returned dictionaries are shared - treat them as read only.
+'''
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def load_config(config_file):
+    '''
+    Return the parsed contents of a yaml config file using the cached copy if the file has not changed
+    :param config_file: path to the yaml file
+    :return: dictionary with the parsed yaml
+    '''
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader
+
+    config_path = os.path.abspath(os.path.expanduser(config_file))
+    file_stat = os.stat(config_path)
+    file_version = (file_stat.st_mtime, file_stat.st_size)
+
+    with _configs_lock:
+        cached = _configs.get(config_path)
+        if cached is not None and cached[0] == file_version:
+            return cached[1]
+
+    with open(config_path, 'r') as f:
+        config_data = yaml.load(f, Loader=Loader)
+
+    with _configs_lock:
+        _configs[config_path] = (file_version, config_data)
+
+    return config_data
+
+
+def clear_config_cache(config_file=None):
+    '''
+    Forget the cached copy of config_file or of all config files if none is given
+    :param config_file:
+    :return:
+    '''
+    with _configs_lock:
+        if config_file is None:
+            _configs.clear()
+        else:
+            _configs.pop(os.path.abspath(os.path.expanduser(config_file)), None)
+    return
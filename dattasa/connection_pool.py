@@ -0,0 +1,311 @@
+import threading
+import time
+import os
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+'''
+Process wide pool of database connections keyed by the config file, db_host entry of database.yaml and user.
+Pool settings can be overridden for each db_host in the config file -
+
+gp3: &gp3
+    adapter: greenplum
+    ...
+    pool_min_size: 1            connections opened when the pool is created
+    pool_max_size: 5            maximum connections (idle + checked out) against the host
+    pool_max_idle: 300          seconds an idle connection is kept before it is closed
+    pool_max_lifetime: 3600     seconds after which a connection is recycled
+    pool_timeout: 30            seconds to wait for a free connection before giving up
+'''
+
+POOL_DEFAULTS = {
+    'pool_min_size': 0,
+    'pool_max_size': 5,
+    'pool_max_idle': 300,
+    'pool_max_lifetime': 3600,
+    'pool_timeout': 30,
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class _PooledConnection():
+    '''
+    Book keeping for a single connection held by the pool
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+
+class ConnectionPool():
+    '''
+    Thread safe pool of connections for a single db_host.
+    connect_function opens a new connection, validate_function raises an exception if a connection is not usable
+    and reset_function is called when a connection is returned to the pool (eg:- rollback open transaction)
+    '''
+
+    def __init__(self, connect_function, validate_function=None, reset_function=None,
+                 min_size=0, max_size=5, max_idle=300, max_lifetime=3600, timeout=30):
+        self.connect_function = connect_function
+        self.validate_function = validate_function
+        self.reset_function = reset_function
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+
+        self.lock = threading.Condition(threading.Lock())
+        self.idle = []
+        self.checked_out = {}
+        # connections being opened, validated or closed outside the lock still count against max_size
+        self.busy = 0
+        self.closed = False
+
+        for i in range(self.min_size):
+            self.idle.append(_PooledConnection(self.connect_function()))
+
+        return
+
+    def __total(self):
+        return len(self.idle) + len(self.checked_out) + self.busy
+
+    def size(self):
+        with self.lock:
+            return self.__total()
+
+    def __past_lifetime(self, pooled, now):
+        return bool(self.max_lifetime) and now - pooled.created_at > self.max_lifetime
+
+    def __expired(self, pooled, now):
+        if self.__past_lifetime(pooled, now):
+            return True
+        if self.max_idle and now - pooled.last_used > self.max_idle and self.__total() > self.min_size:
+            return True
+        return False
+
+    def __discard(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+        return
+
+    def __release_busy(self, count=1):
+        with self.lock:
+            self.busy -= count
+            self.lock.notify_all()
+        return
+
+    def evict_idle(self):
+        '''
+        Close idle connections that have gone past max_idle or max_lifetime
+        :return: number of connections closed
+        '''
+        now = time.time()
+        evicted = []
+        with self.lock:
+            for pooled in list(self.idle):
+                if self.__expired(pooled, now):
+                    self.idle.remove(pooled)
+                    evicted.append(pooled)
+            self.busy += len(evicted)
+        for pooled in evicted:
+            self.__discard(pooled)
+        if evicted:
+            self.__release_busy(len(evicted))
+        return len(evicted)
+
+    def get_connection(self, timeout=None):
+        '''
+        Checkout a connection from the pool. A new connection is opened if none are idle and
+        pool has not reached max_size (idle + checked out connections), otherwise waits for a connection
+        to be returned
+        :param timeout: seconds to wait for a connection. Default is the pool timeout
+        :return: database connection
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        self.evict_idle()
+
+        while True:
+            pooled = None
+            with self.lock:
+                if self.closed:
+                    raise Exception('connection pool has been closed')
+                while not self.idle and self.__total() >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout('timed out waiting for a connection. pool_max_size=' +
+                                          str(self.max_size))
+                    self.lock.wait(remaining)
+                    if self.closed:
+                        raise Exception('connection pool has been closed')
+                if self.idle:
+                    pooled = self.idle.pop()
+                # hold the slot while the connection is validated or opened outside the lock
+                self.busy += 1
+
+            try:
+                if pooled is None:
+                    pooled = _PooledConnection(self.connect_function())
+                elif self.validate_function is not None:
+                    try:
+                        self.validate_function(pooled.conn)
+                    except Exception:
+                        self.__discard(pooled)
+                        pooled = None
+            except Exception:
+                self.__release_busy()
+                raise
+
+            with self.lock:
+                self.busy -= 1
+                if pooled is None:
+                    # health check failed, try again with another connection
+                    self.lock.notify_all()
+                    continue
+                pooled.last_used = time.time()
+                self.checked_out[id(pooled.conn)] = pooled
+            return pooled.conn
+
+    def put_connection(self, conn, discard=False):
+        '''
+        Return a connection to the pool. Broken connections or connections past max_lifetime are closed
+        instead of being reused.
+        The connection counts against max_size until it is back in the pool or closed
+        :param conn:
+        :param discard: close the connection instead of returning it to the pool
+        :return:
+        '''
+        with self.lock:
+            pooled = self.checked_out.get(id(conn))
+        if pooled is None:
+            return
+
+        if not discard and self.reset_function is not None:
+            try:
+                self.reset_function(conn)
+            except Exception:
+                discard = True
+
+        now = time.time()
+        with self.lock:
+            if self.checked_out.pop(id(conn), None) is None:
+                return
+            # max_idle only applies to connections sitting in the pool, not to the time it was checked out
+            pooled.last_used = now
+            keep = not (discard or self.closed or self.__past_lifetime(pooled, now))
+            if keep:
+                self.idle.append(pooled)
+                self.lock.notify()
+            else:
+                self.busy += 1
+        if not keep:
+            self.__discard(pooled)
+            self.__release_busy()
+        return
+
+    @contextmanager
+    def connection(self, timeout=None):
+        '''
+        Context manager that borrows a connection and always returns it to the pool.
+        Connection is discarded if the block raises a database error
+        '''
+        conn = self.get_connection(timeout)
+        try:
+            yield conn
+        except Exception:
+            self.put_connection(conn, discard=is_connection_broken(conn))
+            raise
+        else:
+            self.put_connection(conn)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.lock.notify_all()
+        for pooled in idle:
+            self.__discard(pooled)
+        return
+
+
+def is_connection_broken(conn):
+    '''
+    psycopg2 sets closed to a non zero value and pymysql sets open to False on a dropped connection
+    '''
+    closed = getattr(conn, 'closed', 0)
+    if closed and closed is not False:
+        return True
+    if getattr(conn, 'open', True) is False:
+        return True
+    return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def get_pool(db_host, db_credentials, connect_function, validate_function=None, reset_function=None,
+             config_file=None):
+    '''
+    Return the process wide pool for db_host creating it on first use.
+    Pools are keyed by config_file, db_host and user, so clients with different credentials never share a pool.
+    Pools are not shared with child processes - a forked process starts with an empty registry
+    :param db_host: name of the entry in database.yaml
+    :param db_credentials: parsed database.yaml
+    :param connect_function:
+    :param validate_function:
+    :param reset_function:
+    :param config_file: config file db_credentials were read from
+    :return: ConnectionPool
+    '''
+    pool_key = (config_file, db_host, db_credentials[db_host].get('user'))
+    global _pools, _pools_pid
+
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # connections can not be used across a fork. forget the parent's pools without closing them
+            _pools = {}
+            _pools_pid = os.getpid()
+
+        pool = _pools.get(pool_key)
+        if pool is None or pool.closed:
+            settings = dict(POOL_DEFAULTS)
+            for key in POOL_DEFAULTS:
+                if key in db_credentials[db_host]:
+                    settings[key] = db_credentials[db_host][key]
+            pool = ConnectionPool(connect_function, validate_function, reset_function,
+                                  min_size=settings['pool_min_size'],
+                                  max_size=settings['pool_max_size'],
+                                  max_idle=settings['pool_max_idle'],
+                                  max_lifetime=settings['pool_max_lifetime'],
+                                  timeout=settings['pool_timeout'])
+            _pools[pool_key] = pool
+
+    return pool
+
+
+def close_all_pools():
+    '''
+    Close idle connections of every pool in this process
+    '''
+    global _pools
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools = {}
+    for pool in pools:
+        pool.close()
+    return
@@ -0,0 +1,399 @@
+import io
+import os
+import sys
+import shutil
+import threading
+import datetime as dt
+import json
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+'''
+In-memory streaming between a producer (eg:- COPY ... TO STDOUT on a source database) and a consumer
+(eg:- COPY ... FROM STDIN on a target database) without writing a temporary file.
+The pipe holds at most max_chunks chunks of chunk_size characters, so a fast producer blocks until
+the consumer catches up. Extract and load run at the same time in separate threads.
+'''
+
+
+class PipeAborted(Exception):
+    pass
+
+
+if sys.version_info.major == 3:
+    def reraise(exc_info):
+        '''
+        Raise an exception caught in another thread with its original traceback
+        :param exc_info: (type, value, traceback) returned by sys.exc_info()
+        '''
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec("""def reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
+""")
+
+
+class BoundedPipe(io.TextIOBase):
+    '''
+    File like object that one or more writer threads write to and a reader thread reads from.
+    A single writer can use write(). When several writers share the pipe, each writer must put()
+    complete lines so that rows from different writers do not get mixed up.
+    Every writer calls finish_writer() when done. The reader gets end of file after the last writer finishes.
+    '''
+
+    def __init__(self, max_chunks=64, chunk_size=65536, writers=1, translator=None):
+        super(BoundedPipe, self).__init__()
+        self.chunks = queue.Queue(max_chunks)
+        self.chunk_size = chunk_size
+        self.translator = translator
+        self.writers = writers
+        self.writers_lock = threading.Lock()
+        self.write_buffer = []
+        self.write_buffer_size = 0
+        self.read_buffer = ''
+        self.eof = False
+        self.error = None
+        return
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        self.write_buffer.append(data)
+        self.write_buffer_size += len(data)
+        if self.write_buffer_size >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.write_buffer_size > 0:
+            chunk = ''.join(self.write_buffer)
+            self.write_buffer = []
+            self.write_buffer_size = 0
+            if self.translator is not None:
+                chunk = self.translator.translate(chunk)
+            self.put(chunk)
+        return
+
+    def put(self, chunk):
+        '''
+        Add a chunk to the pipe, waiting while the pipe is full
+        :param chunk:
+        :return:
+        '''
+        while True:
+            if self.error is not None:
+                raise PipeAborted('pipe aborted: {0}'.format(self.error))
+            try:
+                self.chunks.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def finish_writer(self):
+        '''
+        Called by each writer once it has written all its data
+        :return:
+        '''
+        self.flush()
+        if self.translator is not None:
+            remainder = self.translator.flush()
+            if remainder:
+                self.put(remainder)
+        with self.writers_lock:
+            self.writers -= 1
+            last_writer = self.writers <= 0
+        if last_writer:
+            self.put(None)
+        return
+
+    def abort(self, error):
+        '''
+        Stop the pipe. Readers and writers waiting on the pipe raise PipeAborted
+        :param error: reason for aborting
+        :return:
+        '''
+        if self.error is None:
+            self.error = error
+        return
+
+    def __get(self):
+        while True:
+            if self.error is not None:
+                raise PipeAborted('pipe aborted: {0}'.format(self.error))
+            try:
+                return self.chunks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def __fill(self):
+        chunk = self.__get()
+        if chunk is None:
+            self.eof = True
+        else:
+            self.read_buffer += chunk
+        return
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self.eof:
+                self.__fill()
+            data = self.read_buffer
+            self.read_buffer = ''
+            return data
+
+        while len(self.read_buffer) < size and not self.eof:
+            self.__fill()
+        data = self.read_buffer[:size]
+        self.read_buffer = self.read_buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self.read_buffer and not self.eof:
+            self.__fill()
+        position = self.read_buffer.find('\n')
+        end = len(self.read_buffer) if position < 0 else position + 1
+        if size is not None and 0 <= size < end:
+            end = size
+        data = self.read_buffer[:end]
+        self.read_buffer = self.read_buffer[end:]
+        return data
+
+
+class CopyTextTranslator():
+    '''
+    Translate rows in postgres COPY text format from one delimiter / NULL string to another.
+    Delimiter characters inside values are backslash escaped in text format.
+    Works on chunks that do not end on a row boundary - the partial row is kept until the next chunk.
+    '''
+
+    def __init__(self, source_delimiter='\t', target_delimiter='\t',
+                 source_null_string='\\N', target_null_string='\\N'):
+        self.source_delimiter = source_delimiter
+        self.target_delimiter = target_delimiter
+        self.source_null_string = source_null_string
+        self.target_null_string = target_null_string
+        self.partial_line = ''
+        return
+
+    def __translate_field(self, field):
+        if field == self.source_null_string:
+            return self.target_null_string
+        if self.target_delimiter in field:
+            return field.replace(self.target_delimiter, '\\' + self.target_delimiter)
+        return field
+
+    def __split_escaped(self, line):
+        '''
+        split a line that has backslash escapes on the unescaped source delimiter.
+        escaped source delimiters are unescaped since they are no longer special in the target
+        '''
+        fields = []
+        raw_fields = []
+        field = []
+        raw_field = []
+        position = 0
+        while position < len(line):
+            char = line[position]
+            if char == '\\' and position + 1 < len(line):
+                next_char = line[position + 1]
+                raw_field.append(char + next_char)
+                field.append(next_char if next_char == self.source_delimiter else char + next_char)
+                position += 2
+                continue
+            if char == self.source_delimiter:
+                fields.append(''.join(field))
+                raw_fields.append(''.join(raw_field))
+                field = []
+                raw_field = []
+            else:
+                field.append(char)
+                raw_field.append(char)
+            position += 1
+        fields.append(''.join(field))
+        raw_fields.append(''.join(raw_field))
+        return fields, raw_fields
+
+    def translate_line(self, line):
+        if '\\' not in line.replace(self.source_null_string, ''):
+            return self.target_delimiter.join([self.__translate_field(field)
+                                               for field in line.split(self.source_delimiter)])
+        translated = []
+        for field, raw_field in zip(*self.__split_escaped(line)):
+            if raw_field == self.source_null_string:
+                translated.append(self.target_null_string)
+            elif self.target_delimiter in field:
+                translated.append(field.replace(self.target_delimiter, '\\' + self.target_delimiter))
+            else:
+                translated.append(field)
+        return self.target_delimiter.join(translated)
+
+    def translate(self, chunk):
+        lines = (self.partial_line + chunk).split('\n')
+        self.partial_line = lines.pop()
+        if len(lines) == 0:
+            return ''
+        return '\n'.join([self.translate_line(line) for line in lines]) + '\n'
+
+    def flush(self):
+        remainder = self.partial_line
+        self.partial_line = ''
+        if remainder == '':
+            return ''
+        return self.translate_line(remainder)
+
+
+def copy_text_escapes(delimiter='\t'):
+    '''
+    Translation table that backslash escapes the characters that are special in COPY text format
+    '''
+    escapes = {ord('\\'): '\\\\', ord('\n'): '\\n', ord('\r'): '\\r', ord('\t'): '\\t'}
+    if ord(delimiter) not in escapes:
+        escapes[ord(delimiter)] = '\\' + delimiter
+    return escapes
+
+
+def copy_text_value(value, escapes, null_string='\\N'):
+    '''
+    Format a single python value as a field in postgres COPY text format
+    :param value:
+    :param escapes: translation table from copy_text_escapes
+    :param null_string:
+    :return:
+    '''
+    if value is None:
+        return null_string
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, dt.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, dt.date):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        ''' bytea hex format '''
+        value = '\\x' + bytes(value).hex()
+    elif isinstance(value, (dict, list)):
+        ''' values json can not encode (datetime, ObjectId, Decimal128 ...) are written as their text '''
+        value = json.dumps(value, default=str)
+    else:
+        value = str(value)
+    return value.translate(escapes)
+
+
+def encode_copy_columns(columns, delimiter='\t', null_string='\\N'):
+    '''
+    Encode a micro batch held as columns (one list of values per column, all of the same length)
+    into rows of postgres COPY text format. Each column is formatted in one pass before the rows are joined
+    :param columns: list of column value lists
+    :param delimiter:
+    :param null_string:
+    :return: string with one line per row
+    '''
+    if len(columns) == 0 or len(columns[0]) == 0:
+        return ''
+    escapes = copy_text_escapes(delimiter)
+    encoded_columns = [[copy_text_value(value, escapes, null_string) for value in column] for column in columns]
+    return ''.join([delimiter.join(row) + '\n' for row in zip(*encoded_columns)])
+
+
+def run_pipe(producers, consumer, pipe):
+    '''
+    Run each producer and the consumer in its own thread, connected through pipe.
+    A producer is a function that takes the pipe and writes to it, the consumer is a function that takes the pipe
+    and reads from it. If any of them fail the pipe is aborted so that the others stop, and the error is raised.
+    :param producers: list of functions
+    :param consumer: function
+    :param pipe: BoundedPipe created with writers=len(producers)
+    :return: value returned by the consumer
+    '''
+    errors = []
+    result = {}
+
+    def run_producer(producer):
+        try:
+            producer(pipe)
+            pipe.finish_writer()
+        except Exception as e:
+            errors.append(sys.exc_info())
+            pipe.abort(e)
+
+    def run_consumer():
+        try:
+            result['value'] = consumer(pipe)
+        except Exception as e:
+            errors.append(sys.exc_info())
+            pipe.abort(e)
+
+    threads = [threading.Thread(target=run_producer, args=(producer,)) for producer in producers]
+    threads.append(threading.Thread(target=run_consumer))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        ''' raise the error that caused the abort rather than the PipeAborted seen by the other side '''
+        root_errors = [error for error in errors if not isinstance(error[1], PipeAborted)]
+        error = root_errors[0] if len(root_errors) > 0 else errors[0]
+        reraise(error)
+
+    return result.get('value')
+
+
+def export_shards(export_shard, output_file, shards, merge_shards=True, log_out=None):
+    '''
+    Export shards of a table at the same time, each in a thread of its own into the file <output_file>_part<n>.
+    export_shard(index, shard_file, header) writes shard index to shard_file and returns the number of rows.
+    header is True for the first shard only, or for every shard if merge_shards=False.
+    If a shard fails, the error is raised with its traceback after all the threads have ended.
+    Shards are merged into output_file as bytes, which works for gzip files too, and then removed
+    :param export_shard: function
+    :param output_file:
+    :param shards: number of shards
+    :param merge_shards: merge the shard files into output_file
+    :param log_out: open log file that gets the row count of every shard
+    :return: (list of files written, list of the row counts of the shards)
+    '''
+    shard_files = [output_file + "_part" + str(index + 1) for index in range(shards)]
+    row_counts = [0] * shards
+    errors = []
+
+    def run_shard(index):
+        try:
+            row_counts[index] = export_shard(index, shard_files[index], index == 0 or not merge_shards)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run_shard, args=(index,)) for index in range(shards)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        reraise(errors[0])
+
+    if log_out is not None:
+        for shard_file, row_count in zip(shard_files, row_counts):
+            log_out.write(str(row_count) + " rows exported to " + shard_file + "\n")
+
+    if not merge_shards:
+        return shard_files, row_counts
+    with open(output_file, 'wb') as out_file:
+        for shard_file in shard_files:
+            with open(shard_file, 'rb') as in_file:
+                shutil.copyfileobj(in_file, out_file, 1024 * 1024)
+            os.remove(shard_file)
+    return [output_file], row_counts
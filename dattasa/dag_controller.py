@@ -7,6 +7,7 @@ import os
 from random import randint
 import pandas as pd
 from dattasa import data_pipeline as dp
+from dattasa import rabbitmq_system
 
 
 def run_script(**kwargs):
@@ -117,46 +118,45 @@ def run_pre_check_scripts(log_file, yaml_file, db_host, pre_check_tables, pre_ch
     '''
 
     db = dp.DataComponent().set_credentials(db_host, yaml_file)
-    conn = db.get_db_conn(True, True, 20)
 
     out_log = open(log_file, "w")
 
     '''
-    Ensure none of the pre check tables are empty.
-    We will ask the DB for five rows and log whether we got them.
-    If there were zero rows, fail the job.
+    Pre-checks borrow a connection from the pool of db_host instead of opening a new connection for every task
     '''
-    for table in pre_check_tables:
-        pre_check_sql = "SELECT * FROM " + table + " LIMIT 5;"
-        pre_check_df = pd.read_sql(pre_check_sql, conn)
-        pre_check_row_count = pre_check_df.shape[0]
-        out_log.write(str(pre_check_row_count) + " rows returned from " + table + "\n")
-        if pre_check_row_count == 0:
-            print ("No rows found in pre check table : " + table + "\n")
-            out_log.close()
-            db.close_connection()
-            raise Exception('pre-check found an empty table ' + table)
-            break
-
-    '''
-    Ensure none of the pre check sql scripts return empty result
-    We will ask the DB for five rows and log whether we got them.
-    If there were zero rows, fail the job.
-    '''
-    for sql_script in pre_check_scripts:
-        pre_check_df = pd.read_sql(sql_script, conn)
-        pre_check_row_count = pre_check_df.shape[0]
-        out_log.write(str(pre_check_row_count) + " rows returned from " + sql_script + "\n")
-        if pre_check_row_count == 0:
-            print ("No rows found for pre check sql : " + sql_script + "\n")
-            print ("SQL File " + file_name + " will not be  run. Aborting ..." + "\n")
-            out_log.close()
-            db.close_connection()
-            raise Exception('pre-check did not return any rows for sql ' + sql_script)
-            break
+    with db.pooled_connection(connect_timeout=20) as conn:
+
+        '''
+        Ensure none of the pre check tables are empty.
+        We will ask the DB for five rows and log whether we got them.
+        If there were zero rows, fail the job.
+        '''
+        for table in pre_check_tables:
+            pre_check_sql = "SELECT * FROM " + table + " LIMIT 5;"
+            pre_check_df = pd.read_sql(pre_check_sql, conn)
+            pre_check_row_count = pre_check_df.shape[0]
+            out_log.write(str(pre_check_row_count) + " rows returned from " + table + "\n")
+            if pre_check_row_count == 0:
+                print ("No rows found in pre check table : " + table + "\n")
+                out_log.close()
+                raise Exception('pre-check found an empty table ' + table)
+
+        '''
+        Ensure none of the pre check sql scripts return empty result
+        We will ask the DB for five rows and log whether we got them.
+        If there were zero rows, fail the job.
+        '''
+        for sql_script in pre_check_scripts:
+            pre_check_df = pd.read_sql(sql_script, conn)
+            pre_check_row_count = pre_check_df.shape[0]
+            out_log.write(str(pre_check_row_count) + " rows returned from " + sql_script + "\n")
+            if pre_check_row_count == 0:
+                print ("No rows found for pre check sql : " + sql_script + "\n")
+                print ("SQL File " + file_name + " will not be  run. Aborting ..." + "\n")
+                out_log.close()
+                raise Exception('pre-check did not return any rows for sql ' + sql_script)
 
     out_log.close()
-    db.close_connection()
 
     return
 
@@ -206,7 +206,8 @@ def load_audit_table(**kwargs):
 
     producer = dp.DataComponent().set_credentials(rabbitmq_host, rabbitmq_config_yaml)
 
-    ''' Publish a message for each table '''
+    ''' Publish a message for each table. All the messages are committed together '''
+    messages = []
     for table_name in load_tables:
         data = {
             "audit_id": audit_id,
@@ -216,15 +217,66 @@ def load_audit_table(**kwargs):
             "audit_table": audit_table,
             "load_time": dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
         }
-        message = json.dumps(data)
-        status = producer.send(queue_name, message, auto_delete=False)
-        print("published message for creating " + load_type + "-load audit record for " + table_name)
+        messages.append(json.dumps(data))
+
+    status = producer.send_many(queue_name, messages, auto_delete=False)
+    if status != "":
+        print(status)
+    else:
+        for table_name in load_tables:
+            print("published message for creating " + load_type + "-load audit record for " + table_name)
 
     producer.stop()
 
     return
 
 
+def consume_audit_messages(**kwargs):
+    '''
+    Write the messages published by load_audit_table to the audit tables in bulk.
+    Can be run as a long running task or scheduled with max_idle_secs so that it exits once the queue is drained
+    :param queue_name:
+    :param rabbitmq_host:
+    :param db_host: database that has the audit tables
+    :param batch_size:
+    :param max_idle_secs:
+    :param audit_tables: list of the audit tables messages may be loaded into. None=any table
+    :return: number of audit records loaded
+    '''
+
+    queue_name = kwargs['queue_name']  # Required Parameter
+    rabbitmq_host = kwargs['rabbitmq_host']  # Required Parameter
+    db_host = kwargs['db_host']  # Required Parameter
+
+    config_yaml = kwargs.get('config_yaml', os.environ['HOME'] + '/database.yaml')
+    batch_size = kwargs.get('batch_size', 500)
+    batch_interval_secs = kwargs.get('batch_interval_secs', 5)
+    max_idle_secs = kwargs.get('max_idle_secs', 60)
+    audit_tables = kwargs.get('audit_tables', None)
+
+    db = dp.DataComponent().set_credentials(db_host, config_yaml)
+    db.get_db_conn()
+
+    consumer = rabbitmq_system.Consumer(config_yaml, db.db_credentials, rabbitmq_host)
+    status = consumer.connect(prefetch_count=batch_size * 2)
+    if status != "":
+        db.close_connection()
+        raise Exception(status)
+
+    try:
+        records_loaded = consumer.consume_audit_records(queue_name, db, batch_size=batch_size,
+                                                        batch_interval_secs=batch_interval_secs,
+                                                        max_idle_secs=max_idle_secs,
+                                                        audit_tables=audit_tables)
+    finally:
+        consumer.close()
+        db.close_connection()
+
+    print(str(records_loaded) + " audit records loaded from " + queue_name)
+
+    return records_loaded
+
+
 def get_copy_mysql_table_to_gp_command(source_table, target_table, source_conn='',
                                        target_conn='', error_limit='2', null_string='',
                                        description=''):
@@ -5,7 +5,7 @@ import multiprocessing
 import os
 import shutil
 import time
-import yaml
+import traceback
 from dattasa import mixpanel_client
 from dattasa import salesforce_client
 from dattasa import wootric_client
@@ -16,6 +16,10 @@ from dattasa import mongo_client
 from dattasa import redis_client
 from dattasa import kafka_system
 from dattasa import rabbitmq_system
+from dattasa import config_registry
+from dattasa import sql_utils
+from dattasa import copy_stream
+from dattasa import file_processor
 
 
 class DataComponent():
@@ -40,16 +44,11 @@ class DataComponent():
         return
 
     def set_credentials(self, config_db, db_config_file=''):
-        try:
-            from yaml import CLoader as Loader, CDumper as Dumper
-        except ImportError:
-            from yaml import Loader, Dumper
 
         if db_config_file == '':
             db_config_file = self.config_file
 
-        with open(db_config_file, 'r') as f:
-            db_credentials = yaml.load(f, Loader=Loader)
+        db_credentials = config_registry.load_config(db_config_file)
 
         try:
             database_adapter = db_credentials[config_db]['adapter']
@@ -88,16 +87,11 @@ class APICall():
         return
 
     def set_credentials(self, config_db, db_config_file=''):
-        try:
-            from yaml import CLoader as Loader, CDumper as Dumper
-        except ImportError:
-            from yaml import Loader, Dumper
 
         if db_config_file == '':
             db_config_file = self.config_file
 
-        with open(db_config_file, 'r') as f:
-            db_credentials = yaml.load(f, Loader=Loader)
+        db_credentials = config_registry.load_config(db_config_file)
 
         try:
             database_adapter = db_credentials[config_db]['adapter']
@@ -150,29 +144,28 @@ class DataProcessor():
         else:
             self.config_file = config_file
 
-        try:
-            from yaml import CLoader as Loader, CDumper as Dumper
-        except ImportError:
-            from yaml import Loader, Dumper
-
-        db_config_file = self.config_file
-        with open(db_config_file, 'r') as f:
-            db_credentials = yaml.load(f, Loader=Loader)
-            self.db_credentials = db_credentials
+        self.db_credentials = config_registry.load_config(self.config_file)
 
         return
 
     def multiprocess_sql_query_run(self, sql_file, log_file, out_file, sql_parameters_list,
-                                   delimited_file=False, file_delimiter=','):
+                                   delimited_file=False, file_delimiter=',', max_workers=None, max_retries=0,
+                                   dedupe_header=False):
         '''
         While creating your sql file make sure to replace all parameters p[parameter_name]
         sql_parameter_list comprises of key value pairs in the form {"parameter_name": "parameter_value" }
+        Parameter sets are queued and run by a pool of max_workers processes, so only max_workers
+        sessions are open against the source at any time. Outputs are merged into out_file in the order of
+        sql_parameters_list while the remaining parameter sets are still running.
         :param sql_file: 
         :param log_file: 
         :param out_file: 
         :param sql_parameters_list: 
         :param delimited_file: 
         :param file_delimiter: 
+        :param max_workers: number of parameter sets run at the same time. Default=number of cpus
+        :param max_retries: number of times a failed parameter set is retried
+        :param dedupe_header: keep the header row of the first output only (for csv outputs with a header)
         :return: 
         '''
         source_adapter = self.db_credentials[self.source_conn]['adapter']
@@ -184,9 +177,9 @@ class DataProcessor():
         if source_adapter in ('greenplum', 'postgres', 'mysql'):
             '''
             Use Multiprocessing - For each subset, substitute varaibles in the sql 
-            and run each sql as a separate process
+            and run each sql as a task in a pool of processes
             '''
-            jobs = []
+            tasks = []
             sql_file_name = os.path.basename(sql_file)
             file_name = sql_file_name.lower().replace('.sql', '')
 
@@ -213,55 +206,76 @@ class DataProcessor():
                 sql_query_file = temp_dir + file_name + '_' + str(file_index) + '.sql'
                 with open(sql_query_file, 'w') as f:
                     f.write(temp_query)
-                    f.close
-                p = multiprocessing.Process(target=run_sql_process,
-                                            args=(self.source_conn,self.config_file, source_adapter,
-                                                  sql_query_file, sql_log_file, sql_out_file,
-                                                  delimited_file, file_delimiter))
-                jobs.append(p)
-                p.start()
-                time.sleep(1)
+                tasks.append({"index": file_index, "source_conn": self.source_conn, "config_file": self.config_file,
+                              "source_adapter": source_adapter, "sql_query_file": sql_query_file,
+                              "log_file": sql_log_file, "out_file": sql_out_file,
+                              "delimited_file": delimited_file, "delimiter": file_delimiter,
+                              "max_retries": max_retries})
+
             '''
-            Since multiprocessing is used, we want to make sure that every process completed with exit code=0
+            Every task reports its exit status, number of attempts and run time.
+            Results come back in parameter order, so the output and log of each parameter set are appended
+            as soon as it and all parameter sets before it have completed
             '''
-            job_exit_codes = []
-            for j in jobs:
-                j.join()
-                job_exit_codes.append(j.exitcode)
-                log_out.write("Exiting " + j.name + " with exitcode = " + str(j.exitcode) + "\n")
-                log_out.write(
-                    "Completed running " + j.name + " at " + str(
-                        dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
-
-            ''' Raise an exception if any exit code is non zero '''
-            if any(job_exit_codes) != 0:
-                log_out.write('psql execution failed while running ' + sql_file + '\n')
-                raise Exception('psql execution failed while running ' + sql_file)
+            failed_tasks = []
+            results_out = open(out_file, 'wb')
+            header_written = False
+            for result in run_sql_tasks(tasks, max_workers, ordered=True):
+                task = tasks[result["index"] - 1]
+                log_sql_task_result(log_out, result)
+                if os.path.exists(task["log_file"]):
+                    file_processor.append_file(task["log_file"], log_out)
+                    os.remove(task["log_file"])
+                os.remove(task["sql_query_file"])
+
+                if result["status"] != "success":
+                    failed_tasks.append(result)
+                elif len(failed_tasks) == 0 and os.path.exists(task["out_file"]):
+                    file_processor.append_file(task["out_file"], results_out,
+                                               skip_header=dedupe_header and header_written)
+                    header_written = True
+                if os.path.exists(task["out_file"]):
+                    os.remove(task["out_file"])
+            results_out.close()
 
-            ''' Delete temporary sql files '''
-            for temp_sql_file in glob.glob(temp_dir + file_name + '*.sql'):
-                os.remove(temp_sql_file)
+            ''' Raise an exception if any task failed '''
+            if len(failed_tasks) > 0:
+                log_out.write('psql execution failed while running ' + sql_file + '\n')
+                log_out.close()
+                raise Exception('psql execution failed while running ' + sql_file + ' for parameter sets ' +
+                                ', '.join([str(result["index"]) for result in failed_tasks]))
 
-            ''' Merge temporary log files '''
-            log_out.close()
-            log_out = open(log_file, 'ab')
-            for log_file in glob.glob(temp_dir + file_name + '*.log'):
-                shutil.copyfileobj(open(log_file, 'rb'), log_out)
-                os.remove(log_file)
             log_out.close()
 
-            ''' Merge temporary out files '''
-            results_out = open(out_file, 'wb')
-            for results_file in glob.glob(temp_dir + file_name + '*.out'):
-                shutil.copyfileobj(open(results_file, 'rb'), results_out)
-                os.remove(results_file)
-            results_out.close()
-
         return
 
     def bulk_load_source_table_to_gp(self, source_table, load_log_file, target_table, target_err_table="",
                                      file_delimiter='|', source_extract_sql=None, full_refresh=True,
-                                     clear_target=True, csv_header=False, null_string='', error_limit="2"):
+                                     clear_target=True, csv_header=False, null_string='', error_limit="2",
+                                     partition_column=None, partition_count=1, partition_method='range',
+                                     max_workers=None):
+        '''
+        Extract source_table (or results of source_extract_sql) from a postgres, mysql or greenplum source
+        and load it into a greenplum target using gpload.
+        To speed up large extracts set partition_column and partition_count. The extract is then split into
+        partition_count chunks that are exported in parallel and all the chunk files are handed to gpload.
+        :param source_table:
+        :param load_log_file:
+        :param target_table:
+        :param target_err_table:
+        :param file_delimiter:
+        :param source_extract_sql:
+        :param full_refresh:
+        :param clear_target:
+        :param csv_header:
+        :param null_string:
+        :param error_limit:
+        :param partition_column: numeric or date column used to split the extract
+        :param partition_count: number of chunks. Default=1 (no partitioning)
+        :param partition_method: range (split min to max of partition_column) or hash (modulo of integer column)
+        :param max_workers: number of chunks extracted at the same time. Default=partition_count
+        :return:
+        '''
 
         source_adapter = self.db_credentials[self.source_conn]['adapter']
         if source_adapter in ('greenplum', 'postgres', 'mysql'):
@@ -272,13 +286,18 @@ class DataProcessor():
                 file_name.replace('.sql', '')
                 extract_file = self.temp_dir + file_name + ".csv"
             else:
+                file_name = source_table
                 sql_file = self.temp_dir + source_table + ".sql"
                 sql_out = open(sql_file, 'w')
                 sql_out.write("SELECT * FROM " + source_table)
                 sql_out.close()
                 extract_file = self.temp_dir + source_table + ".csv"
 
-            if source_adapter == 'mysql':
+            if partition_column and int(partition_count) > 1:
+                extract_file = self.__partitioned_extract(sql_file, file_name, load_log_file, source_adapter,
+                                                          file_delimiter, partition_column, partition_count,
+                                                          partition_method, max_workers)
+            elif source_adapter == 'mysql':
                 data_mysql = DataComponent().set_credentials(self.source_conn, self.config_file)
                 data_mysql.get_db_conn()
                 data_mysql.export_sql_results(sql_file, load_log_file, extract_file, True, file_delimiter)
@@ -312,6 +331,279 @@ class DataProcessor():
 
         return
 
+    def pipe_source_table_to_target(self, source_table, target_table, load_log_file, source_extract_sql=None,
+                                    clear_target=False, delimiter='\t', null_string='\\N',
+                                    target_delimiter=None, target_null_string=None, column_list=[],
+                                    buffer_chunks=64, chunk_size=65536, key_column=None, readers=1,
+                                    page_size=100000):
+        '''
+        Copy source_table (or results of source_extract_sql) from a postgres, greenplum or mysql source into a
+        postgres or greenplum target without a temporary file. COPY TO STDOUT on a postgres source (or a server side
+        cursor on a mysql source, with the rows encoded in COPY text format) is connected to COPY FROM STDIN on
+        the target through a bounded in-memory pipe, so extract and load run at the same time.
+        Set target_delimiter / target_null_string to translate the rows on the fly when the target
+        expects a different format than the source produces.
+        For a mysql source set key_column to read the rows in pages ordered on key_column (keyset pagination) and
+        readers to split the range of key_column between several readers that run at the same time.
+        :param source_table:
+        :param target_table:
+        :param load_log_file:
+        :param source_extract_sql: sql file to run on source instead of SELECT * FROM source_table
+        :param clear_target: truncate target table before the load
+        :param delimiter: delimiter used by the source COPY
+        :param null_string: null string used by the source COPY
+        :param target_delimiter: delimiter used by the target COPY. Default=delimiter
+        :param target_null_string: null string used by the target COPY. Default=null_string
+        :param column_list: target columns in the order of the source columns. Default is all columns
+        :param buffer_chunks: maximum number of chunks held in memory
+        :param chunk_size: size of each chunk in characters
+        :param key_column: mysql source only. unique numeric or date column used for keyset pagination
+        :param readers: mysql source only. number of key ranges read at the same time. Needs key_column
+        :param page_size: mysql source only. rows in each page of the keyset pagination
+        :return: number of rows loaded
+        '''
+        source_adapter = self.db_credentials[self.source_conn]['adapter']
+        target_adapter = self.db_credentials[self.target_conn]['adapter']
+        if source_adapter not in ('greenplum', 'postgres', 'mysql'):
+            raise Exception('postgres, mysql or greenplum source needed to use this method')
+        if int(readers) > 1 and (source_adapter != 'mysql' or key_column is None):
+            raise Exception('parallel readers need a mysql source and key_column')
+        if target_adapter not in ('greenplum', 'postgres'):
+            raise Exception('postgres or greenplum target needed to use this method')
+
+        if source_extract_sql:
+            with open(source_extract_sql, 'r') as f:
+                extract_sql = " ".join(f.readlines())
+        else:
+            extract_sql = "SELECT * FROM " + source_table
+
+        target_delimiter = delimiter if target_delimiter is None else target_delimiter
+        target_null_string = null_string if target_null_string is None else target_null_string
+        if source_adapter == 'mysql':
+            ''' mysql rows are encoded straight into the target format '''
+            translator = None
+        elif target_delimiter != delimiter or target_null_string != null_string:
+            translator = copy_stream.CopyTextTranslator(delimiter, target_delimiter, null_string, target_null_string)
+        else:
+            translator = None
+
+        log_out = open(load_log_file, 'a')
+        start = time.time()
+        log_out.write("Started: piping " + self.source_conn + " to " + self.target_conn + "." + target_table +
+                      " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        data_source = DataComponent().set_credentials(self.source_conn, self.config_file)
+        data_target = DataComponent().set_credentials(self.target_conn, self.config_file)
+        data_source.get_db_conn()
+        data_target.get_db_conn()
+        reader_sources = []
+
+        def extract(pipe):
+            data_source.copy_to_stream(extract_sql, pipe, delimiter, null_string)
+
+        def mysql_reader(reader_source, key_range, null_keys):
+            def extract_range(pipe):
+                reader_source.copy_to_stream(extract_sql, pipe, target_delimiter, target_null_string,
+                                             key_column=key_column, key_range=key_range, page_size=page_size,
+                                             null_keys=null_keys)
+            return extract_range
+
+        def load(pipe):
+            return data_target.copy_from_stream(pipe, target_table, target_delimiter, target_null_string,
+                                                column_list, clear_target)
+
+        try:
+            if source_adapter == 'mysql':
+                if int(readers) > 1:
+                    key_reference = "dattasa_src.`" + sql_utils.output_column_name(key_column) + "`"
+                    key_range = data_source.run_sql_command(
+                        "SELECT MIN({column}), MAX({column}) FROM ({sql}) dattasa_src".format(
+                            column=key_reference, sql=extract_sql.strip().rstrip(';')), fetch=True)
+                    key_ranges = sql_utils.split_key_range(key_range[0][0], key_range[0][1], readers)
+                else:
+                    key_ranges = [(None, None)]
+                producers = []
+                for index, key_range in enumerate(key_ranges):
+                    ''' pymysql connections can not be shared between threads, every reader gets its own '''
+                    if index == 0:
+                        reader_source = data_source
+                    else:
+                        reader_source = DataComponent().set_credentials(self.source_conn, self.config_file)
+                        reader_source.get_db_conn()
+                        reader_sources.append(reader_source)
+                    ''' rows with a NULL key are in none of the ranges, the first reader picks them up '''
+                    producers.append(mysql_reader(reader_source, key_range, index == 0))
+                log_out.write("reading " + self.source_conn + " with " + str(len(producers)) + " readers\n")
+            else:
+                producers = [extract]
+            pipe = copy_stream.BoundedPipe(buffer_chunks, chunk_size, writers=len(producers), translator=translator)
+            row_count = copy_stream.run_pipe(producers, load, pipe)
+        except Exception as e:
+            log_out.write("ERROR: pipe from " + self.source_conn + " to " + target_table +
+                          " failed. error message: {0}".format(e) + "\n")
+            log_out.close()
+            raise
+        finally:
+            data_source.close_connection()
+            data_target.close_connection()
+            for reader_source in reader_sources:
+                reader_source.close_connection()
+
+        end = time.time()
+        log_out.write(str(row_count) + " rows loaded into " + target_table + "\n")
+        log_out.write("Ended: " + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write("Total time taken to run: " + str((end - start) * 1000) + " ms \n")
+        log_out.close()
+
+        return row_count
+
+    def pipe_collection_to_target(self, collection_name, target_table, load_log_file, field_mapping,
+                                  mixpanel_fields={}, mixpanel_query={}, constant_fields={}, clear_target=False,
+                                  readers=4, batch_size=5000, buffer_chunks=64, chunk_size=65536):
+        '''
+        Copy a mongodb collection into a postgres or greenplum table without a temporary file.
+        The collection is split into readers ranges of _id that are read at the same time. Documents are flattened
+        through field_mapping (same format as MongoClient.export_mixpanel_query_results) and fed to
+        COPY FROM STDIN on the target through a bounded in-memory pipe, so extract and load run at the same time.
+        :param collection_name:
+        :param target_table:
+        :param load_log_file:
+        :param field_mapping: list of target columns in order. Each has gp_column_name, gp_column_position,
+        gp_column_type, json_field and gp_value_is_constant
+        :param mixpanel_fields: Default is every json_field of field_mapping
+        :param mixpanel_query: copy only the documents that match this filter
+        :param constant_fields: values of the columns that have gp_value_is_constant set
+        :param clear_target: truncate target table before the load
+        :param readers: number of _id ranges read at the same time
+        :param batch_size: documents fetched from mongo in each round trip
+        :param buffer_chunks: maximum number of chunks held in memory
+        :param chunk_size: size of each chunk in characters
+        :return: number of rows loaded
+        '''
+        source_adapter = self.db_credentials[self.source_conn]['adapter']
+        target_adapter = self.db_credentials[self.target_conn]['adapter']
+        if source_adapter != 'mongodb':
+            raise Exception('mongodb source needed to use this method')
+        if target_adapter not in ('greenplum', 'postgres'):
+            raise Exception('postgres or greenplum target needed to use this method')
+
+        if len(mixpanel_fields) == 0:
+            mixpanel_fields = dict([(config_data['json_field'], 1) for config_data in field_mapping
+                                    if not config_data['gp_value_is_constant'] and config_data['json_field'] != 'id'])
+        column_list = [config_data['gp_column_name'] for config_data in field_mapping]
+
+        log_out = open(load_log_file, 'a')
+        start = time.time()
+        log_out.write("Started: piping " + self.source_conn + "." + collection_name + " to " + self.target_conn +
+                      "." + target_table + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        data_source = DataComponent().set_credentials(self.source_conn, self.config_file)
+        data_target = DataComponent().set_credentials(self.target_conn, self.config_file)
+        data_source.get_db_conn(auth_db=self.db_credentials[self.source_conn]['auth_database'])
+        data_target.get_db_conn()
+
+        def reader(id_range):
+            def extract(pipe):
+                data_source.copy_to_stream(collection_name, pipe, mixpanel_query, mixpanel_fields, field_mapping,
+                                           constant_fields, id_range, batch_size=batch_size)
+            return extract
+
+        def load(pipe):
+            return data_target.copy_from_stream(pipe, target_table, column_list=column_list,
+                                                clear_target=clear_target)
+
+        try:
+            id_ranges = data_source.get_id_ranges(collection_name, readers, mixpanel_query)
+            log_out.write("reading " + collection_name + " in " + str(len(id_ranges)) + " ranges of _id\n")
+            pipe = copy_stream.BoundedPipe(buffer_chunks, chunk_size, writers=len(id_ranges))
+            row_count = copy_stream.run_pipe([reader(id_range) for id_range in id_ranges], load, pipe)
+        except Exception as e:
+            log_out.write("ERROR: pipe from " + self.source_conn + "." + collection_name + " to " + target_table +
+                          " failed. error message: {0}".format(e) + "\n")
+            log_out.close()
+            raise
+        finally:
+            data_source.close_connection()
+            data_target.close_connection()
+
+        end = time.time()
+        log_out.write(str(row_count) + " rows loaded into " + target_table + "\n")
+        log_out.write("Ended: " + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write("Total time taken to run: " + str((end - start) * 1000) + " ms \n")
+        log_out.close()
+
+        return row_count
+
+    def __partitioned_extract(self, sql_file, file_name, load_log_file, source_adapter, file_delimiter,
+                              partition_column, partition_count, partition_method='range', max_workers=None):
+        '''
+        Split the extract sql into partition_count chunks on partition_column and export
+        each chunk as a separate process against the source
+        :return: list of chunk files in partition order
+        '''
+        temp_dir = self.temp_dir
+        with open(sql_file, 'r') as f:
+            extract_sql = " ".join(f.readlines()).strip().rstrip(';')
+
+        min_value = None
+        max_value = None
+        if partition_method == 'range':
+            data_source = DataComponent().set_credentials(self.source_conn, self.config_file)
+            data_source.get_db_conn()
+            key_range = data_source.run_sql_command("SELECT MIN({column}), MAX({column}) FROM ({sql}) dattasa_src".
+                                                    format(column=partition_column, sql=extract_sql), fetch=True)
+            data_source.close_connection()
+            min_value, max_value = key_range[0]
+
+        predicates = sql_utils.partition_predicates(partition_column, partition_count, partition_method,
+                                                    min_value, max_value)
+
+        ''' Delete chunk files from an earlier run '''
+        for temp_file in glob.glob(temp_dir + file_name + '_part*'):
+            os.remove(temp_file)
+
+        chunk_tasks = []
+        chunk_files = []
+        chunk_logs = []
+        for index, predicate in enumerate(predicates):
+            chunk_name = temp_dir + file_name + '_part' + str(index + 1)
+            with open(chunk_name + '.sql', 'w') as f:
+                f.write("SELECT * FROM (" + extract_sql + ") dattasa_src WHERE " + predicate)
+            chunk_files.append(chunk_name + '.csv')
+            chunk_logs.append(chunk_name + '.log')
+            chunk_tasks.append({"index": index + 1, "source_conn": self.source_conn, "config_file": self.config_file,
+                                "source_adapter": source_adapter, "sql_query_file": chunk_name + '.sql',
+                                "log_file": chunk_name + '.log', "out_file": chunk_name + '.csv',
+                                "delimited_file": True, "delimiter": file_delimiter})
+
+        log_out = open(load_log_file, 'a')
+        log_out.write("Started partitioned extract of " + sql_file + " in " + str(len(chunk_tasks)) +
+                      " chunks at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.close()
+
+        failed_tasks = []
+        for result in run_sql_tasks(chunk_tasks, max_workers if max_workers else len(chunk_tasks)):
+            if result["status"] != "success":
+                failed_tasks.append(result)
+
+        ''' Merge chunk log files '''
+        log_out = open(load_log_file, 'ab')
+        for chunk_log in chunk_logs:
+            if os.path.exists(chunk_log):
+                shutil.copyfileobj(open(chunk_log, 'rb'), log_out)
+                os.remove(chunk_log)
+        log_out.close()
+
+        if len(failed_tasks) > 0:
+            ''' remove the chunks that did export so that a partial extract is never loaded '''
+            for chunk_file in chunk_files:
+                if os.path.exists(chunk_file):
+                    os.remove(chunk_file)
+            raise Exception('partitioned extract failed while running ' + sql_file + ' for chunks ' +
+                            ', '.join([str(result["index"]) for result in failed_tasks]))
+
+        return chunk_files
+
 
 def run_sql_process(source_conn, config_file, source_adapter, sql_query_file, log_file,
                     out_file, delimited_file=False, delimiter=","):
@@ -335,8 +627,105 @@ def run_sql_process(source_conn, config_file, source_adapter, sql_query_file, lo
         data_comp.run_psql_file(sql_query_file, log_file, out_file, delimited_file, delimiter)
     else:
         data_comp.get_db_conn()
-        data_comp.export_sql_results(sql_query_file, log_file, out_file,delimited_file, delimiter)
-        data_comp.commit_query()
-        data_comp.close_connection()
+        try:
+            data_comp.export_sql_results(sql_query_file, log_file, out_file,delimited_file, delimiter)
+            data_comp.commit_query()
+        finally:
+            data_comp.close_connection()
+
+    return
+
+
+def run_sql_task(task):
+    '''
+    Run a single task of run_sql_tasks in a pool process. Failed tasks are retried up to task["max_retries"] times.
+    out_file and log_file of the task are cleared before every attempt. Logs of the failed attempts are kept
+    Errors are returned instead of raised so that the remaining tasks keep running
+    :param task: dictionary with the arguments of run_sql_process and index of the task
+    :return: dictionary with index, status, attempts, start_time, end_time and error of the task
+    '''
+    max_retries = int(task.get("max_retries", 0))
+    result = {"index": task["index"], "status": "failed", "attempts": 0, "error": "",
+              "start_time": dt.datetime.now()}
+
+    earlier_log = ""
+    while result["attempts"] <= max_retries:
+        result["attempts"] += 1
+        ''' every attempt starts with an empty out_file and log_file so that a failed attempt leaves no partial
+        rows in the output and its errors are not picked up by the log check of psql on the next attempt '''
+        if os.path.exists(task["log_file"]):
+            with open(task["log_file"], 'r') as f:
+                earlier_log += f.read()
+        for file_name in (task["out_file"], task["log_file"]):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        with open(task["log_file"], 'w') as f:
+            f.write("Task " + str(task["index"]) + " attempt " + str(result["attempts"]) + " started at " +
+                    dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + "\n")
+        try:
+            run_sql_process(task["source_conn"], task["config_file"], task["source_adapter"],
+                            task["sql_query_file"], task["log_file"], task["out_file"],
+                            task["delimited_file"], task["delimiter"])
+            result["status"] = "success"
+            result["error"] = ""
+            break
+        except Exception:
+            result["error"] = traceback.format_exc()
+            if result["attempts"] <= max_retries:
+                time.sleep(task.get("retry_delay", 5))
+
+    ''' keep the logs of the failed attempts ahead of the log of the last attempt '''
+    if earlier_log != "":
+        with open(task["log_file"], 'r') as f:
+            last_log = f.read()
+        with open(task["log_file"], 'w') as f:
+            f.write(earlier_log + last_log)
+
+    result["end_time"] = dt.datetime.now()
+    return result
+
+
+def run_sql_tasks(tasks, max_workers=None, ordered=False):
+    '''
+    Generator that runs tasks using a pool of max_workers processes and yields the result of
+    each task as soon as it completes. Tasks are started as slots in the pool free up
+    :param tasks: list of task dictionaries (see run_sql_task)
+    :param max_workers: Default=number of cpus
+    :param ordered: yield results in the order of tasks. A result is yielded once the task and all the
+    tasks before it have completed
+    :return: generator of task results
+    '''
+    if len(tasks) == 0:
+        return
+    if not max_workers:
+        max_workers = multiprocessing.cpu_count()
+    max_workers = min(int(max_workers), len(tasks))
+
+    pool = multiprocessing.Pool(processes=max_workers)
+    try:
+        if ordered:
+            results = pool.imap(run_sql_task, tasks)
+        else:
+            results = pool.imap_unordered(run_sql_task, tasks)
+        for result in results:
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return
+
 
+def log_sql_task_result(log_out, result):
+    log_out.write("Task " + str(result["index"]) + " " + result["status"] +
+                  " after " + str(result["attempts"]) + " attempt(s)." +
+                  " Started at " + result["start_time"].strftime("%Y-%m-%d %H:%M:%S") +
+                  " Completed at " + result["end_time"].strftime("%Y-%m-%d %H:%M:%S") +
+                  " Run time " + str((result["end_time"] - result["start_time"]).total_seconds() * 1000) +
+                  " ms\n")
+    if result["error"] != "":
+        log_out.write(result["error"] + "\n")
     return
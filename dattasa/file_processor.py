@@ -1,11 +1,13 @@
 import paramiko
 import sys
-import yaml
 import os
 import gnupg
 import pprint
 import json
 import csv
+import shutil
+import gzip
+from dattasa import config_registry
 
 
 class File():
@@ -137,15 +139,9 @@ class FileTransfer():
         else:
             self.config_file = config_file
 
-        try:
-            from yaml import CLoader as Loader , CDumper as Dumper
-        except ImportError:
-            from yaml import Loader, Dumper
-
-        with open(config_file , 'r') as f:
-            file_credentials = yaml.load(f, Loader=Loader)
-            self.sftp_site = sftp_site
-            self.sftp_credentials = file_credentials[sftp_site]
+        file_credentials = config_registry.load_config(self.config_file)
+        self.sftp_site = sftp_site
+        self.sftp_credentials = file_credentials[sftp_site]
 
         return
 
@@ -244,6 +240,42 @@ def json_loads_byteified(json_text):
     )
 
 
+def append_file(file_name, out_file, skip_header=False):
+    '''
+    Append the contents of file_name to an open file. The file is copied in binary or text mode
+    depending on the mode of out_file
+    :param file_name:
+    :param out_file: open file object
+    :param skip_header: do not copy the first line of file_name
+    :return:
+    '''
+    read_mode = 'rb' if 'b' in getattr(out_file, 'mode', 'b') else 'r'
+    with open(file_name, read_mode) as in_file:
+        if skip_header:
+            in_file.readline()
+        shutil.copyfileobj(in_file, out_file, 1024 * 1024)
+    return
+
+
+def open_text_file(file_name, mode='r', compress=False):
+    '''
+    Open a file to read or write text line by line (and with the csv module) on python 2 and 3.
+    On python 3 the file is opened in text mode with newline='', on python 2 in binary mode
+    since the python 2 csv module reads and writes bytes
+    :param file_name:
+    :param mode: r, w or a
+    :param compress: gzip file
+    :return: file object
+    '''
+    if sys.version_info.major == 3:
+        if compress:
+            return gzip.open(file_name, mode + 't', newline='')
+        return open(file_name, mode, newline='')
+    if compress:
+        return gzip.open(file_name, mode + 'b')
+    return open(file_name, mode + 'b')
+
+
 def write_dict_to_csv(csv_file, csv_columns, dict_data, delimiter):
     try:
         with open(csv_file , 'w') as csvfile:
@@ -1,11 +1,20 @@
 import threading, time
+import collections
 import multiprocessing
 import socket
 import json
 import os
+import gzip
+import io
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from kafka import KafkaConsumer, KafkaProducer, TopicPartition
 from kafka.common import LeaderNotAvailableError
 from kafka.errors import KafkaError
+from dattasa import copy_stream
 
 
 '''
@@ -77,6 +86,19 @@ service kafdrop start
 
 
 class BatchProducer(threading.Thread):
+    '''
+    Publishes messages to kafka using a single KafkaProducer that is created on first use and kept open
+    until stop() or close() is called. Messages sent with send(wait=False), send_async or send_many(flush=False)
+    are only queued - call flush(), stop() or close(), or use the producer in a with block, to deliver them
+    before the process exits.
+        with BatchProducer(config_file, db_credentials, db_host) as producer:
+            producer.send_many(topic_name, messages, flush=False)
+    Producer settings can be added to the kafka entry in the config file -
+        linger_ms: 5                time to wait for more messages before sending a batch
+        batch_size: 65536           maximum size of a batch in bytes
+        compression_type: gzip      gzip, snappy, lz4 or none
+        max_in_flight: 10000        maximum messages waiting for acknowledgement before send blocks
+    '''
     def __init__(self, config_file, db_credentials, db_host):
         threading.Thread.__init__(self)
         self.config_file = config_file
@@ -84,41 +106,169 @@ class BatchProducer(threading.Thread):
         self.db_credentials = db_credentials
         self.db_host = db_host
         self.bootstrap_servers = self.db_credentials[self.db_host]['bootstrap_servers']
+
+        kafka_credentials = self.db_credentials[self.db_host]
+        self.linger_ms = kafka_credentials.get('linger_ms', 5)
+        self.batch_size = kafka_credentials.get('batch_size', 65536)
+        self.compression_type = kafka_credentials.get('compression_type', None)
+        if self.compression_type == 'none':
+            self.compression_type = None
+        self.max_in_flight = kafka_credentials.get('max_in_flight', 10000)
+
+        self.producer = None
+        self.in_flight = collections.deque()
+        self.producer_lock = threading.Lock()
         return
 
     def stop(self):
         self.stop_event.set()
+        self.close()
         return
 
-    def send(self, topic_name, message, topic_partition=-1):
-
-        producer = KafkaProducer(bootstrap_servers=self.bootstrap_servers,
-                                 value_serializer=lambda v: json.dumps(v).encode('utf-8'))
+    def get_producer(self):
+        '''
+        Return the KafkaProducer of this BatchProducer creating it on first use
+        '''
+        with self.producer_lock:
+            if self.producer is None:
+                self.producer = KafkaProducer(bootstrap_servers=self.bootstrap_servers,
+                                              value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+                                              linger_ms=self.linger_ms,
+                                              batch_size=self.batch_size,
+                                              compression_type=self.compression_type)
+        return self.producer
+
+    def __wait_for_window(self, timeout=None):
+        '''
+        Backpressure - forget acknowledged messages and block on the oldest one while
+        max_in_flight messages are still waiting for acknowledgement
+        '''
+        in_flight = self.in_flight
+        while len(in_flight) > 0 and in_flight[0].is_done:
+            future = in_flight.popleft()
+            if future.failed():
+                raise future.exception
+        while len(in_flight) >= self.max_in_flight:
+            in_flight.popleft().get(timeout=timeout)
+        return
 
+    def send_async(self, topic_name, message, topic_partition=-1, key=None):
+        '''
+        Queue a message in the producer and return without waiting for it to be delivered.
+        Blocks if max_in_flight messages are waiting for acknowledgement
+        :param topic_name:
+        :param message: any json serializable value
+        :param topic_partition: Default=-1 lets kafka choose the partition
+        :param key: message key (bytes)
+        :return: future that resolves to the RecordMetadata of the message
+        '''
+        producer = self.get_producer()
+        self.__wait_for_window()
+        partition = None if topic_partition == -1 else topic_partition
         try:
-            exception = ""
-            if topic_partition == -1:
-                producer.send(topic_name, message)
-            else:
-                producer.send(topic_name, message, partition=topic_partition)
-
+            future = producer.send(topic_name, message, partition=partition, key=key)
         except LeaderNotAvailableError:
             # https://github.com/mumrah/kafka-python/issues/249
             time.sleep(1)
-            if topic_partition == -1:
-                producer.send(topic_name, message)
-            else:
-                producer.send(topic_name, message, partition=topic_partition)
+            future = producer.send(topic_name, message, partition=partition, key=key)
+        self.in_flight.append(future)
+        return future
+
+    def send(self, topic_name, message, topic_partition=-1, wait=True):
+        '''
+        Publish a message using the long lived producer. By default send waits until the message is delivered,
+        same as before the producer was kept open. With wait=False the message is only queued and delivered in
+        a batch - call flush() or stop(), or use the BatchProducer in a with block, to make sure queued messages
+        are delivered. Messages still queued when the process exits can be lost
+        :param topic_name:
+        :param message:
+        :param topic_partition:
+        :param wait: wait for the message to be delivered
+        :return: error message if the message could not be published
+        '''
+        exception = ""
+        try:
+            self.send_async(topic_name, message, topic_partition)
+        except KafkaError as ex:
+            print(ex)
+            exception = str(ex)
+
+        if wait and exception == "":
+            exception = self.flush()
 
+        return exception
+
+    def send_many(self, topic_name, messages, topic_partition=-1, key_function=None, flush=True):
+        '''
+        Publish every message of an iterable. Messages are batched by the producer and at most
+        max_in_flight of them are waiting for acknowledgement at any time
+        :param topic_name:
+        :param messages: iterable of json serializable values
+        :param topic_partition: Default=-1 lets kafka choose the partition
+        :param key_function: function that returns the key of a message
+        :param flush: wait till all the messages are delivered
+        :return: error message if any message could not be published
+        '''
+        exception = ""
+        try:
+            for message in messages:
+                key = key_function(message) if key_function is not None else None
+                self.send_async(topic_name, message, topic_partition, key)
         except KafkaError as ex:
             print(ex)
             exception = str(ex)
 
-        finally:
-            producer.close()
+        if flush and exception == "":
+            exception = self.flush()
+
+        return exception
+
+    def flush(self, timeout=None):
+        '''
+        Block until every queued message has been delivered
+        :param timeout: seconds to wait
+        :return: error message if any message could not be delivered
+        '''
+        exception = ""
+        if self.producer is None:
+            return exception
+
+        try:
+            self.producer.flush(timeout)
+            while len(self.in_flight) > 0:
+                future = self.in_flight.popleft()
+                if future.failed() and exception == "":
+                    exception = str(future.exception)
+        except KafkaError as ex:
+            exception = str(ex)
+
+        if exception != "":
+            print(exception)
+            self.in_flight.clear()
 
         return exception
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self, timeout=None):
+        '''
+        Deliver the queued messages and close the producer
+        '''
+        exception = ""
+        with self.producer_lock:
+            producer = self.producer
+        if producer is not None:
+            exception = self.flush(timeout)
+            producer.close(timeout)
+            with self.producer_lock:
+                self.producer = None
+        return exception
+
 
 class BatchConsumer(multiprocessing.Process):
 
@@ -130,6 +280,7 @@ class BatchConsumer(multiprocessing.Process):
         self.db_credentials = db_credentials
         self.db_host = db_host
         self.bootstrap_servers = self.db_credentials[self.db_host]['bootstrap_servers']
+        self.work = None
 
         return
 
@@ -137,18 +288,93 @@ class BatchConsumer(multiprocessing.Process):
         self.stop_event.set()
         return
 
+    def assign_work(self, topic_name, topic_partition=None, group_id="", client_id="",
+                    out_dir='', out_file_name='', stats_queue=None, **batch_options):
+        '''
+        Set what the consumer does when it is started as a separate process with start().
+        run() connects and drains the topic (or a single partition) using receive_batches
+        :param topic_name:
+        :param topic_partition: partition read by this consumer. Default=partitions assigned by the consumer group
+        :param group_id:
+        :param client_id:
+        :param out_dir:
+        :param out_file_name:
+        :param stats_queue: multiprocessing queue where the consumer reports progress and lag after each batch
+        :param batch_options: other arguments of receive_batches
+        :return:
+        '''
+        self.work = {"topic_name": topic_name, "topic_partition": topic_partition, "group_id": group_id,
+                     "client_id": client_id, "out_dir": out_dir, "out_file_name": out_file_name,
+                     "stats_queue": stats_queue, "batch_options": batch_options}
+        return
+
+    def run(self):
+        '''
+        Entry point of the consumer process. See assign_work
+        '''
+        work = self.work
+        if work is None:
+            raise Exception('call assign_work before starting ' + self.name)
+        stats_queue = work["stats_queue"]
+
+        def report_stats(stats):
+            if stats_queue is None:
+                return
+            consumer = self.consumer
+            assignment = list(consumer.assignment())
+            lag = {}
+            if len(assignment) > 0:
+                end_offsets = consumer.end_offsets(assignment)
+                for partition in assignment:
+                    lag[partition.partition] = end_offsets[partition] - consumer.position(partition)
+            elapsed = time.time() - stats["start_time"]
+            stats_queue.put({"worker": self.name, "messages": stats["messages"], "batches": stats["batches"],
+                             "bytes": stats["bytes"], "lag": lag,
+                             "messages_per_sec": stats["messages"] / elapsed if elapsed > 0 else 0,
+                             "done": False, "exception": ""})
+            return
+
+        exception = ""
+        try:
+            exception = self.connect(work["group_id"], work["client_id"], raw_values=True)
+            if exception == "":
+                exception = self.receive_batches(work["topic_name"], work["topic_partition"], work["out_dir"],
+                                                 work["out_file_name"], stats_callback=report_stats,
+                                                 **work["batch_options"])
+                self.close()
+        except Exception as ex:
+            exception = str(ex)
+        finally:
+            ''' the fleet waits for this message to know that the consumer has exited '''
+            if stats_queue is not None:
+                stats_queue.put({"worker": self.name, "done": True, "exception": exception})
+        return
+
     def connect(self, group_id="", client_id="",
-                auto_offset_reset='earliest', consumer_timeout_ms=1000):
+                auto_offset_reset='earliest', consumer_timeout_ms=1000, raw_values=False):
+        '''
+        Create the KafkaConsumer. Offsets are not committed automatically
+        :param group_id:
+        :param client_id:
+        :param auto_offset_reset:
+        :param consumer_timeout_ms:
+        :param raw_values: keep message values as bytes instead of decoding the json (used by receive_batches)
+        :return:
+        '''
 
         client_id = socket.gethostname() if client_id == "" else client_id
         group_id = os.getlogin() if group_id == "" else group_id
 
         exception = ""
         try:
+            if raw_values:
+                value_deserializer = None
+            else:
+                value_deserializer = lambda m: json.loads(m.decode('utf-8'))
             consumer = KafkaConsumer(bootstrap_servers=self.bootstrap_servers,
                                      auto_offset_reset=auto_offset_reset,
                                      consumer_timeout_ms=consumer_timeout_ms,
-                                     value_deserializer=lambda m: json.loads(m.decode('utf-8')),
+                                     value_deserializer=value_deserializer,
                                      group_id=group_id,
                                      client_id=client_id,
                                      enable_auto_commit=False
@@ -237,6 +463,92 @@ class BatchConsumer(multiprocessing.Process):
 
         return exception
 
+    def receive_batches(self, topic_name, topic_partition=None, out_dir='', out_file_name='',
+                        max_records=5000, poll_timeout_ms=1000, max_empty_polls=1, compress=False,
+                        roll_size_mb=256, roll_interval_secs=None, buffer_size=1048576, stats_callback=None):
+        '''
+        Drain a topic in batches. Each poll returns up to max_records messages which are serialized together,
+        written through a large buffered (optionally gzip) file and flushed to disk before the offsets are
+        committed. Output files are rolled by size and / or time and named
+        <out_dir>/<out_file_name>_<partition or all>_<sequence>.txt(.gz)
+        Connect with raw_values=True so that json values on a single line are copied to the file without decoding
+        them into python objects.
+        Stops when stop() is called or after max_empty_polls polls in a row return no messages.
+        :param topic_name:
+        :param topic_partition: read only this partition. Default is all partitions of the topic
+        :param out_dir: Default=$HOME
+        :param out_file_name: Default=<db_host>_<topic_name>
+        :param max_records: maximum messages in a batch
+        :param poll_timeout_ms: time to wait for messages in each poll
+        :param max_empty_polls: stop after these many empty polls. None=run until stop() is called
+        :param compress: gzip the output files
+        :param roll_size_mb: start a new file after these many MB. None=no size limit
+        :param roll_interval_secs: start a new file after these many seconds. None=no time limit
+        :param buffer_size: size of the file buffer in bytes
+        :param stats_callback: function called with a dictionary of stats after each batch is committed
+        :return: error message if the drain failed
+        '''
+        exception = ""
+        consumer = self.consumer
+        writer = None
+
+        try:
+            if out_dir == '':
+                out_dir = os.environ['HOME']
+            if out_file_name == '':
+                out_file_name = str(self.db_host) + "_" + str(topic_name)
+
+            if topic_partition is None:
+                consumer.subscribe(topic_name)
+                file_prefix = out_dir + "/" + out_file_name + "_all"
+            else:
+                consumer.assign([TopicPartition(topic_name, topic_partition)])
+                file_prefix = out_dir + "/" + out_file_name + "_" + str(topic_partition)
+
+            writer = _RollingFileWriter(file_prefix, compress, roll_size_mb, roll_interval_secs, buffer_size)
+            stats = {"topic": topic_name, "partition": topic_partition, "messages": 0, "batches": 0,
+                     "bytes": 0, "offsets": {}, "start_time": time.time()}
+            empty_polls = 0
+
+            while not self.stop_event.is_set():
+                batch = consumer.poll(timeout_ms=poll_timeout_ms, max_records=max_records)
+                if len(batch) == 0:
+                    empty_polls += 1
+                    if max_empty_polls is not None and empty_polls >= max_empty_polls:
+                        break
+                    continue
+                empty_polls = 0
+
+                lines = []
+                for partition, messages in batch.items():
+                    lines.extend([_message_to_json_line(message) for message in messages])
+                    stats["offsets"][partition.partition] = messages[-1].offset
+
+                ''' offsets are committed only after the batch is on disk '''
+                stats["bytes"] += writer.write("".join(lines))
+                writer.sync()
+                consumer.commit()
+
+                stats["messages"] += len(lines)
+                stats["batches"] += 1
+                if stats_callback is not None:
+                    stats_callback(stats)
+
+                if writer.needs_roll():
+                    writer.roll()
+
+        except KafkaError as ex:
+            print(ex)
+            exception = str(ex)
+            consumer.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return exception
+
     def commit(self):
         self.consumer.commit()
         return
@@ -245,3 +557,396 @@ class BatchConsumer(multiprocessing.Process):
         self.consumer.close()
         return
 
+
+class ConsumerFleet():
+    '''
+    Drain a topic with several BatchConsumer processes. By default one consumer is started for each partition
+    of the topic, or set worker_count to start that many consumers in the same consumer group.
+    Each consumer writes its own output files. monitor() aggregates the lag and throughput that the
+    consumers report and stop() stops all of them.
+    fleet = ConsumerFleet(config_file, db_credentials, 'kafka-smash01', 'events', out_dir='/data/events')
+    fleet.start()
+    fleet.monitor()
+    '''
+    def __init__(self, config_file, db_credentials, db_host, topic_name, worker_count=None,
+                 group_id="", out_dir='', out_file_name='', **batch_options):
+        self.config_file = config_file
+        self.db_credentials = db_credentials
+        self.db_host = db_host
+        self.topic_name = topic_name
+        self.worker_count = worker_count
+        self.group_id = group_id
+        self.out_dir = out_dir
+        self.out_file_name = out_file_name if out_file_name != '' else str(db_host) + "_" + str(topic_name)
+        self.batch_options = batch_options
+        self.stats_queue = multiprocessing.Queue()
+        self.workers = []
+        self.worker_stats = {}
+        return
+
+    def get_partitions(self):
+        consumer = KafkaConsumer(bootstrap_servers=self.db_credentials[self.db_host]['bootstrap_servers'])
+        try:
+            partitions = consumer.partitions_for_topic(self.topic_name)
+        finally:
+            consumer.close()
+        if not partitions:
+            raise Exception('no partitions found for topic ' + str(self.topic_name))
+        return sorted(partitions)
+
+    def start(self):
+        '''
+        Start the consumer processes
+        :return: list of consumers
+        '''
+        group_id = os.getlogin() if self.group_id == "" else self.group_id
+        if self.worker_count is None:
+            assignments = [(partition, self.out_file_name) for partition in self.get_partitions()]
+        else:
+            assignments = [(None, self.out_file_name + "_worker" + str(index + 1))
+                           for index in range(int(self.worker_count))]
+
+        for topic_partition, out_file_name in assignments:
+            worker = BatchConsumer(self.config_file, self.db_credentials, self.db_host)
+            worker.assign_work(self.topic_name, topic_partition, group_id=group_id, out_dir=self.out_dir,
+                               out_file_name=out_file_name, stats_queue=self.stats_queue, **self.batch_options)
+            worker.start()
+            self.workers.append(worker)
+
+        return self.workers
+
+    def __collect_stats(self, timeout):
+        try:
+            stats = self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        worker_stats = self.worker_stats.setdefault(stats["worker"], {})
+        worker_stats.update(stats)
+        return True
+
+    def summary(self):
+        '''
+        Aggregate of the latest stats reported by each consumer
+        :return: dictionary with messages, messages_per_sec, lag per partition, total lag and errors
+        '''
+        summary = {"messages": 0, "messages_per_sec": 0, "lag": {}, "total_lag": 0, "errors": {}}
+        for worker_name, stats in self.worker_stats.items():
+            summary["messages"] += stats.get("messages", 0)
+            if not stats.get("done"):
+                summary["messages_per_sec"] += stats.get("messages_per_sec", 0)
+            summary["lag"].update(stats.get("lag", {}))
+            if stats.get("exception"):
+                summary["errors"][worker_name] = stats["exception"]
+        summary["total_lag"] = sum(summary["lag"].values())
+        return summary
+
+    def monitor(self, interval_secs=10, verbose=True):
+        '''
+        Collect stats from the consumers until all of them have exited, printing a summary every interval_secs
+        :return: final summary
+        '''
+        last_print = time.time()
+        while any([worker.is_alive() for worker in self.workers]):
+            self.__collect_stats(timeout=1)
+            if verbose and time.time() - last_print >= interval_secs:
+                summary = self.summary()
+                print("{0} messages, {1:.0f} messages/sec, total lag {2}".format(
+                    summary["messages"], summary["messages_per_sec"], summary["total_lag"]))
+                last_print = time.time()
+
+        while self.__collect_stats(timeout=0.1):
+            pass
+        for worker in self.workers:
+            worker.join()
+
+        summary = self.summary()
+        if verbose:
+            print("fleet finished. {0} messages, total lag {1}".format(summary["messages"], summary["total_lag"]))
+            for worker_name, exception in summary["errors"].items():
+                print(worker_name + " failed: " + exception)
+        return summary
+
+    def stop(self, timeout=60):
+        '''
+        Ask every consumer to stop after its current batch and wait for them to exit
+        '''
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join(timeout)
+        return
+
+
+class PostgresSink():
+    '''
+    Load messages from a topic straight into a postgres / greenplum table without an intermediate file.
+    Messages are buffered by column into micro batches. Each batch is loaded with COPY FROM STDIN in its own
+    transaction and the kafka offsets are committed only after the database commit, so a failure between the
+    two delivers the batch again (at least once). A batch is loaded once it has batch_size messages or
+    batch_interval_secs have passed since its first message, whichever comes first.
+    source is a KafkaConsumer that has subscribed / been assigned the topic (eg:- BatchConsumer.consumer)
+    or any object with the same poll() and commit() methods such as InMemorySource.
+
+    consumer = BatchConsumer(config_file, db_credentials, 'kafka-smash01')
+    consumer.connect(group_id='events_loader')
+    consumer.consumer.subscribe('events')
+    db = PostgresClient(config_file, db_credentials, 'gp3')
+    db.get_db_conn()
+    sink = PostgresSink(consumer.consumer, db, 'stage.events', ['event_id', 'user_id', 'event_time'])
+    sink.run()
+    '''
+    def __init__(self, source, db, table_name, column_list, batch_size=10000, batch_interval_secs=5,
+                 poll_timeout_ms=500, value_function=None, delimiter='\t', null_string='\\N'):
+        '''
+        :param source: KafkaConsumer or InMemorySource
+        :param db: PostgresClient or GreenplumClient with a psycopg2 connection (get_db_conn)
+        :param table_name: schema_name.table_name
+        :param column_list: target columns. Values are picked by name from json objects or by position from lists
+        :param batch_size: load after these many messages
+        :param batch_interval_secs: load after these many seconds even if the batch is not full
+        :param poll_timeout_ms:
+        :param value_function: function that returns the row (dictionary or list) for a message.
+        Default decodes message.value as json if it is not already decoded
+        :param delimiter:
+        :param null_string:
+        '''
+        self.source = source
+        self.db = db
+        self.table_name = table_name
+        self.column_list = list(column_list)
+        self.batch_size = batch_size
+        self.batch_interval_secs = batch_interval_secs
+        self.poll_timeout_ms = poll_timeout_ms
+        self.value_function = _decode_message_value if value_function is None else value_function
+        self.delimiter = delimiter
+        self.null_string = null_string
+        self.stats = {"messages": 0, "batches": 0, "start_time": time.time()}
+        self.__clear_batch()
+        return
+
+    def __clear_batch(self):
+        self.columns = [[] for column in self.column_list]
+        self.batch_count = 0
+        self.batch_started = None
+        return
+
+    def __add_message(self, message):
+        row = self.value_function(message)
+        if isinstance(row, dict):
+            for column, column_name in zip(self.columns, self.column_list):
+                column.append(row.get(column_name))
+        else:
+            if len(row) != len(self.column_list):
+                raise Exception('message at offset ' + str(message.offset) + ' has ' + str(len(row)) +
+                                ' values, expected ' + str(len(self.column_list)))
+            for column, value in zip(self.columns, row):
+                column.append(value)
+        self.batch_count += 1
+        return
+
+    def batch_is_due(self):
+        if self.batch_count == 0:
+            return False
+        if self.batch_count >= self.batch_size:
+            return True
+        return self.batch_interval_secs is not None and \
+            time.time() - self.batch_started >= self.batch_interval_secs
+
+    def flush(self):
+        '''
+        Load the current micro batch and then commit the offsets of its messages.
+        The database transaction is rolled back and the error is raised if the load fails,
+        in which case the offsets are not committed
+        :return: number of rows loaded
+        '''
+        if self.batch_count == 0:
+            return 0
+        data = copy_stream.encode_copy_columns(self.columns, self.delimiter, self.null_string)
+        row_count = self.db.copy_from_stream(io.StringIO(data), self.table_name, self.delimiter,
+                                             self.null_string, column_list=self.column_list, commit=True)
+        self.source.commit()
+        self.stats["messages"] += self.batch_count
+        self.stats["batches"] += 1
+        self.__clear_batch()
+        return row_count
+
+    def run(self, stop_event=None, max_empty_polls=1, max_batches=None, verbose=False):
+        '''
+        Poll the source and load micro batches until stop_event is set, the source has been
+        idle for max_empty_polls polls or max_batches batches have been loaded. Any partial batch is loaded before
+        returning
+        :param stop_event: threading or multiprocessing Event
+        :param max_empty_polls: None=run until stopped
+        :param max_batches:
+        :param verbose: print throughput after each batch
+        :return: dictionary with messages and batches loaded
+        '''
+        empty_polls = 0
+        while stop_event is None or not stop_event.is_set():
+            if max_batches is not None and self.stats["batches"] >= max_batches:
+                break
+            batch = self.source.poll(timeout_ms=self.poll_timeout_ms,
+                                     max_records=self.batch_size - self.batch_count)
+            if len(batch) == 0:
+                empty_polls += 1
+                if max_empty_polls is not None and empty_polls >= max_empty_polls:
+                    break
+            else:
+                empty_polls = 0
+                if self.batch_started is None:
+                    self.batch_started = time.time()
+                for partition, messages in batch.items():
+                    for message in messages:
+                        self.__add_message(message)
+
+            if self.batch_is_due():
+                self.flush()
+                if verbose:
+                    elapsed = time.time() - self.stats["start_time"]
+                    print("{0} messages loaded into {1}, {2:.0f} messages/sec".format(
+                        self.stats["messages"], self.table_name, self.stats["messages"] / max(elapsed, 0.001)))
+
+        self.flush()
+        return self.stats
+
+
+class InMemorySource():
+    '''
+    Stand in for a KafkaConsumer that serves a list of messages. Used to run PostgresSink
+    (or anything else that polls a consumer) without a kafka cluster.
+    commit() records the offset of the last message handed out by poll()
+    '''
+    Message = collections.namedtuple('Message', ['topic', 'partition', 'offset', 'key', 'value',
+                                                 'timestamp', 'timestamp_type'])
+
+    def __init__(self, values, topic_name='in_memory', topic_partition=0):
+        self.topic_partition = TopicPartition(topic_name, topic_partition)
+        self.messages = [self.Message(topic_name, topic_partition, offset, None, value, None, None)
+                         for offset, value in enumerate(values)]
+        self.position = 0
+        self.committed = None
+        return
+
+    def poll(self, timeout_ms=0, max_records=None):
+        if self.position >= len(self.messages):
+            return {}
+        end = len(self.messages) if max_records is None else min(self.position + max_records, len(self.messages))
+        messages = self.messages[self.position:end]
+        self.position = end
+        return {self.topic_partition: messages}
+
+    def commit(self):
+        if self.position > 0:
+            self.committed = self.position - 1
+        return
+
+
+def _decode_message_value(message):
+    if isinstance(message.value, bytes):
+        return json.loads(message.value.decode('utf-8'))
+    if isinstance(message.value, str):
+        return json.loads(message.value)
+    return message.value
+
+
+class _RollingFileWriter():
+    '''
+    Buffered (optionally gzip) writer for BatchConsumer output that starts a new file by size or time
+    '''
+    def __init__(self, file_prefix, compress=False, roll_size_mb=256, roll_interval_secs=None,
+                 buffer_size=1048576):
+        self.file_prefix = file_prefix
+        self.compress = compress
+        self.roll_size_bytes = roll_size_mb * 1024 * 1024 if roll_size_mb else None
+        self.roll_interval_secs = roll_interval_secs
+        self.buffer_size = buffer_size
+        self.sequence = 0
+        self.files = []
+        self.raw_file = None
+        self.out_file = None
+        self.__open()
+        return
+
+    def __open(self):
+        self.sequence += 1
+        file_name = self.file_prefix + "_" + str(self.sequence).zfill(5) + ".txt"
+        if self.compress:
+            file_name += ".gz"
+        self.raw_file = open(file_name, 'wb', self.buffer_size)
+        if self.compress:
+            self.out_file = gzip.GzipFile(fileobj=self.raw_file, mode='wb')
+        else:
+            self.out_file = self.raw_file
+        self.bytes_written = 0
+        self.opened_at = time.time()
+        self.files.append(file_name)
+        return
+
+    def write(self, data):
+        data = data.encode('utf-8')
+        self.out_file.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def sync(self):
+        '''
+        Make sure everything written so far is on disk
+        '''
+        self.out_file.flush()
+        self.raw_file.flush()
+        os.fsync(self.raw_file.fileno())
+        return
+
+    def needs_roll(self):
+        if self.roll_size_bytes and self.bytes_written >= self.roll_size_bytes:
+            return True
+        if self.roll_interval_secs and time.time() - self.opened_at >= self.roll_interval_secs:
+            return True
+        return False
+
+    def roll(self):
+        self.close()
+        self.__open()
+        return
+
+    def close(self):
+        if self.compress:
+            self.out_file.close()
+        self.raw_file.close()
+        if self.bytes_written == 0 and len(self.files) > 1:
+            ''' do not leave an empty file behind after the last roll '''
+            os.remove(self.files.pop())
+        return
+
+
+def _message_to_json_line(message):
+    '''
+    Serialize a kafka message to a json line. Values that were not decoded (raw bytes) are copied into the
+    line as is when they are json on a single line. Json spread over several lines is serialized again on one
+    line and values that are not json are written as a json string
+    '''
+    key = message.key.decode('utf-8') if isinstance(message.key, bytes) else message.key
+    if isinstance(message.value, bytes):
+        value = _raw_value_to_json(message.value)
+    else:
+        value = json.dumps(message.value)
+    return '{"topic": ' + json.dumps(message.topic) + \
+           ', "partition": ' + str(message.partition) + \
+           ', "offset": ' + str(message.offset) + \
+           ', "key": ' + json.dumps(key) + \
+           ', "value": ' + value + \
+           ', "timestamp": ' + json.dumps(message.timestamp) + \
+           ', "timestamp_type": ' + json.dumps(message.timestamp_type) + '}\n'
+
+
+def _raw_value_to_json(raw_value):
+    text = raw_value.decode('utf-8', 'replace').strip()
+    if text == '':
+        return 'null'
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        return json.dumps(text)
+    if '\n' in text or '\r' in text:
+        return json.dumps(parsed, separators=(',', ':'))
+    return text
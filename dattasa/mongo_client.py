@@ -2,6 +2,19 @@ import pymongo
 import os, subprocess
 import sys
 import re
+import csv
+import time
+import threading
+import datetime as dt
+import bson
+from bson import json_util
+from dattasa import file_processor
+from dattasa import copy_stream
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 class MongoClient():
@@ -199,7 +212,73 @@ class MongoClient():
         return
 
     def load_file_to_collection(self, collection_name, input_file, log_file,
-                                database_name="", csv_file=False, drop_target=False):
+                                database_name="", csv_file=False, drop_target=False, use_mongoimport=False,
+                                batch_size=1000, workers=4, upsert_keys=[], index_list=[]):
+        '''
+        Load a csv file (with header line) or a json file (one document per line) into a collection.
+        The file is read in batches of batch_size documents which are written by several threads with
+        unordered insert_many, or bulk_write upserts when upsert_keys are given. Documents that fail
+        are logged with the batch they belong to and the load raises an exception at the end.
+        Indexes in index_list are built after the load.
+        Set use_mongoimport=True to run the mongoimport tool instead
+        :param collection_name:
+        :param input_file:
+        :param log_file:
+        :param database_name: Default is the database in the config file
+        :param csv_file: input_file is a csv file with a header line. Numbers are loaded as numbers
+        :param drop_target: drop the collection before loading
+        :param use_mongoimport:
+        :param batch_size: documents in each write
+        :param workers: number of threads writing to mongo
+        :param upsert_keys: replace the document that matches these fields instead of inserting
+        :param index_list: indexes to build after loading.
+        eg:- [{"index_name": "user_idx", "field_list": [{"user_id": "A"}], "unique": False}]
+        :return: dictionary with the number of documents written and failed
+        '''
+        if use_mongoimport:
+            return self.__run_mongoimport(collection_name, input_file, log_file,
+                                          database_name, csv_file, drop_target)
+
+        mongo_credentials = self.db_credentials[self.db_host]
+        if database_name == "":
+            mongo_database = mongo_credentials['database']
+        else:
+            mongo_database = database_name
+
+        mongo_client = self.get_db_conn(auth_db=mongo_credentials['auth_database'])
+        if drop_target:
+            mongo_client[mongo_database].drop_collection(collection_name)
+        mongo_collection = mongo_client[mongo_database][collection_name]
+
+        log_out = open(log_file, 'a')
+        try:
+            start_time = time.time()
+            stats = _write_batches(mongo_collection, _read_documents(input_file, csv_file, batch_size),
+                                   workers, upsert_keys, log_out)
+            elapsed = max(time.time() - start_time, 0.001)
+            summary = "{0} documents loaded into {1}.{2}, {3} failed, {4:.0f} docs/sec".format(
+                stats["documents"], mongo_database, collection_name, stats["failed"], stats["documents"] / elapsed)
+            log_out.write(summary + "\n")
+            print(summary)
+
+            if stats["failed"] == 0:
+                self.collection = mongo_collection
+                for index in index_list:
+                    self.create_collection_index(index["index_name"], index["field_list"],
+                                                 unique=index.get("unique", False))
+                    log_out.write("built index " + index["index_name"] + "\n")
+        finally:
+            log_out.close()
+            mongo_client.close()
+
+        if stats["failed"] > 0:
+            print("Check " + log_file + " for the documents that failed")
+            raise Exception('import to mongodb failed - ' + str(stats["failed"]) + ' documents failed')
+
+        return stats
+
+    def __run_mongoimport(self, collection_name, input_file, log_file,
+                          database_name="", csv_file=False, drop_target=False):
 
         mongo_credentials = self.db_credentials[self.db_host]
         mongo_user = mongo_credentials['user']
@@ -263,7 +342,90 @@ class MongoClient():
         return
 
     def export_collection_to_file(self, collection_name, output_file, log_file,
-                                  database_name="", csv_file=False, csv_fields=""):
+                                  database_name="", csv_file=False, csv_fields="", use_mongoexport=False,
+                                  query={}, workers=4, batch_size=5000, merge_shards=True):
+        '''
+        Export a collection to a csv file or a json file (one document per line, mongo extended json).
+        The collection is split into workers ranges of _id using split points sampled from the collection and
+        the ranges are scanned at the same time, each into its own shard file <output_file>_part<n>.
+        The shards are merged into output_file unless merge_shards=False.
+        Set use_mongoexport=True to run the mongoexport tool instead
+        :param collection_name:
+        :param output_file:
+        :param log_file:
+        :param database_name: Default is the database in the config file
+        :param csv_file: write a csv file with a header line
+        :param csv_fields: comma separated fields for the csv file. Nested fields use dots eg:- properties.city
+        :param use_mongoexport:
+        :param query: export only the documents that match this filter
+        :param workers: number of ranges scanned at the same time
+        :param batch_size: documents fetched from the server in each round trip
+        :param merge_shards: merge the shard files into output_file
+        :return: list of files written
+        '''
+        if use_mongoexport:
+            return self.__run_mongoexport(collection_name, output_file, log_file,
+                                          database_name, csv_file, csv_fields)
+
+        mongo_credentials = self.db_credentials[self.db_host]
+        if database_name == "":
+            mongo_database = mongo_credentials['database']
+        else:
+            mongo_database = database_name
+
+        if csv_file:
+            field_list = [field.strip() for field in csv_fields.split(',') if field.strip() != '']
+            if len(field_list) == 0:
+                raise Exception('csv_fields are needed to export a csv file')
+            projection = dict([(field, 1) for field in field_list])
+        else:
+            field_list = []
+            projection = None
+
+        mongo_client = self.get_db_conn(auth_db=mongo_credentials['auth_database'])
+        log_out = open(log_file, 'a')
+        try:
+            mongo_collection = mongo_client[mongo_database][collection_name]
+            id_ranges = _id_ranges(mongo_collection, workers, query)
+            shard_files = [output_file + "_part" + str(index + 1) for index in range(len(id_ranges))]
+            write_header = csv_file and not merge_shards
+            getters = [_path_getter(field) for field in field_list]
+
+            def export_range(index):
+                lower, upper = id_ranges[index]
+                cursor = mongo_collection.find(_id_range_filter(query, lower, upper), projection,
+                                               batch_size=batch_size)
+                return _write_documents(cursor, shard_files[index], field_list, getters, write_header)
+
+            start_time = time.time()
+            document_counts = _run_threads(export_range, len(id_ranges))
+            for shard_file, document_count in zip(shard_files, document_counts):
+                log_out.write(str(document_count) + " documents exported to " + shard_file + "\n")
+
+            if merge_shards:
+                with open(output_file, 'w') as out_file:
+                    if csv_file:
+                        csv.writer(out_file, lineterminator='\n').writerow(field_list)
+                    for shard_file in shard_files:
+                        file_processor.append_file(shard_file, out_file)
+                        os.remove(shard_file)
+                output_files = [output_file]
+            else:
+                output_files = shard_files
+
+            elapsed = max(time.time() - start_time, 0.001)
+            summary = "{0} documents exported from {1}.{2} using {3} ranges, {4:.0f} docs/sec".format(
+                sum(document_counts), mongo_database, collection_name, len(id_ranges), sum(document_counts) / elapsed)
+            log_out.write(summary + "\n")
+            print(summary)
+        finally:
+            log_out.close()
+            mongo_client.close()
+
+        return output_files
+
+    def __run_mongoexport(self, collection_name, output_file, log_file,
+                          database_name="", csv_file=False, csv_fields=""):
 
         mongo_credentials = self.db_credentials[self.db_host]
         mongo_user = mongo_credentials['user']
@@ -326,8 +488,27 @@ class MongoClient():
 
     def export_mixpanel_query_results(self, collection_name, mixpanel_query, mixpanel_fields,
                                       results_csv_file, constant_fields={}, field_mapping={},
-                                      file_delimiter=",", header_row=False):
-
+                                      file_delimiter=",", header_row=False, use_aggregation=True,
+                                      batch_size=5000, rows_per_write=1000):
+        '''
+        Export the mixpanel events that match mixpanel_query to a delimited file laid out by field_mapping.
+        The field mapping is compiled once into a plan. With use_aggregation=True the fields are picked and
+        flattened by the server in a $project stage, otherwise the documents are read with find and flattened
+        here. Rows are written rows_per_write at a time
+        :param collection_name:
+        :param mixpanel_query: filter on the events
+        :param mixpanel_fields: fields to export eg:- {"event": 1, "properties.distinct_id": 1}
+        :param results_csv_file:
+        :param constant_fields: values of the columns that have gp_value_is_constant set
+        :param field_mapping: list of output columns in order. Each has gp_column_name, gp_column_position,
+        gp_column_type, json_field and gp_value_is_constant
+        :param file_delimiter:
+        :param header_row: write the column names as the first line
+        :param use_aggregation: project and flatten the fields on the server
+        :param batch_size: documents fetched from the server in each round trip
+        :param rows_per_write:
+        :return: number of rows written
+        '''
         mongo_credentials = self.db_credentials[self.db_host]
         mongo_database = mongo_credentials['database']
         mongo_auth_database = mongo_credentials['auth_database']
@@ -338,79 +519,479 @@ class MongoClient():
         ''' initialize collection '''
         mongo_collection = mongo_client[mongo_database][collection_name]
 
-        with open(results_csv_file, 'w') as f:
-
-            ''' header row '''
-            if header_row:
-                out_header_row = ""
-                for config_data in field_mapping:
-                    gp_column_name = config_data['gp_column_name']
-                    out_header_row += str(gp_column_name) + str(file_delimiter)
-
-                f.write(out_header_row.rstrip(str(file_delimiter)) + '/n')
-
-            ''' detail row - process each row in the order in which the fields appear '''
-            cursor = mongo_collection.find(mixpanel_query, mixpanel_fields)
-            key_list = mixpanel_fields.keys()
-
-            for row in cursor:
-
-                out_dict = dict()
-                out_dict["id"] = row["_id"]
-                for key in key_list:
-                    if key.startswith("properties"):
-                        property_name = key.split('.')[1]
-                        try:
-                            field_value = row["properties"][property_name]
-                        except KeyError:
-                            field_value = ""
-                    else:
-                        field_value = row[key]
-
-                    try:
-                        out_dict[str(key)] = field_value.replace(file_delimiter, "").replace('\r\n', '').replace('\r', '').replace('\n', '')
-                    except AttributeError:
-                        out_dict[str(key)] = field_value
-
-                out_row = ""
-                for config_data in field_mapping:
-
-                    gp_column_name = config_data['gp_column_name']
-                    gp_column_position = config_data['gp_column_position']
-                    gp_column_type = config_data['gp_column_type']
-                    json_field_name = config_data['json_field']
-
-                    if config_data['gp_value_is_constant']:
-                        try:
-                            column_value = constant_fields[gp_column_name]
-                        except KeyError:
-                            column_value = ""
-                    else:
-                        try:
-                            column_value = out_dict[json_field_name]
-                        except KeyError:
-                            column_value = ""
-
-                    if gp_column_type == "varchar":
-                        try:
-                            column_value = str(column_value)
-                        except UnicodeError:
-                            column_value = re.sub(r'[^\x00-\x7f]', r'', column_value)
-                    else:
-                        column_value = str(column_value)
-
-                    if column_value == "None":
-                        column_value = ""
-
-                    if gp_column_position == 1:
-                        out_row += column_value
-                    else:
-                        out_row += file_delimiter + column_value
-
-                f.write(str(out_row) + "\n")
-
-            f.close
+        plan = _FieldPlan(mixpanel_fields, field_mapping, constant_fields, file_delimiter, projected=use_aggregation)
+        row_count = 0
+
+        try:
+            with open(results_csv_file, 'w') as f:
+
+                ''' header row '''
+                if header_row:
+                    f.write(file_delimiter.join(plan.column_names) + '\n')
+
+                ''' detail rows '''
+                if use_aggregation:
+                    cursor = mongo_collection.aggregate(plan.pipeline(mixpanel_query), batchSize=batch_size)
+                else:
+                    cursor = mongo_collection.find(mixpanel_query, mixpanel_fields, batch_size=batch_size)
+
+                text_row = plan.text_row
+                lines = []
+                for document in cursor:
+                    lines.append(file_delimiter.join(text_row(document)) + '\n')
+                    if len(lines) >= rows_per_write:
+                        f.writelines(lines)
+                        row_count += len(lines)
+                        lines = []
+                f.writelines(lines)
+                row_count += len(lines)
+        finally:
             mongo_client.close()
 
+        return row_count
+
+    def get_id_ranges(self, collection_name, partitions, query={}, database_name=""):
+        '''
+        Split a collection into ranges of _id with about the same number of documents.
+        Connection must be established prior to calling this function
+        :param collection_name:
+        :param partitions:
+        :param query: split only the documents that match this filter
+        :param database_name: Default is the database in the config file
+        :return: list of (lower, upper) tuples. lower is inclusive, upper is exclusive and None is unbounded.
+        The last range covers the documents whose _id is of another type than the split points
+        '''
+        if database_name == "":
+            database_name = self.db_credentials[self.db_host]['database']
+        return _id_ranges(self.mongo_client[database_name][collection_name], partitions, query)
+
+    def copy_to_stream(self, collection_name, stream, mixpanel_query={}, mixpanel_fields={}, field_mapping=[],
+                       constant_fields={}, id_range=(None, None), delimiter='\t', null_string='\\N',
+                       batch_size=5000, rows_per_write=1000, database_name=""):
+        '''
+        Write documents as rows in postgres COPY text format laid out by field_mapping (see
+        export_mixpanel_query_results). Fields are flattened on the server with an aggregation pipeline.
+        Rows are added to stream rows_per_write at a time with stream.put so that several
+        readers can share a copy_stream.BoundedPipe.
+        Connection must be established prior to calling this function
+        :param collection_name:
+        :param stream: copy_stream.BoundedPipe
+        :param mixpanel_query: filter on the documents
+        :param mixpanel_fields:
+        :param field_mapping:
+        :param constant_fields:
+        :param id_range: (lower, upper) range of _id to read. See get_id_ranges
+        :param delimiter:
+        :param null_string:
+        :param batch_size: documents fetched from the server in each round trip
+        :param rows_per_write:
+        :param database_name: Default is the database in the config file
+        :return: number of rows written
+        '''
+        if database_name == "":
+            database_name = self.db_credentials[self.db_host]['database']
+        mongo_collection = self.mongo_client[database_name][collection_name]
+
+        plan = _FieldPlan(mixpanel_fields, field_mapping, constant_fields, projected=True)
+        query = _id_range_filter(mixpanel_query, id_range[0], id_range[1])
+        cursor = mongo_collection.aggregate(plan.pipeline(query), batchSize=batch_size)
+
+        row_count = 0
+        rows = []
+        for document in cursor:
+            rows.append(plan.values(document))
+            if len(rows) >= rows_per_write:
+                stream.put(copy_stream.encode_copy_columns(list(zip(*rows)), delimiter, null_string))
+                row_count += len(rows)
+                rows = []
+        if len(rows) > 0:
+            stream.put(copy_stream.encode_copy_columns(list(zip(*rows)), delimiter, null_string))
+            row_count += len(rows)
+
+        return row_count
+
+
+_INTEGER_PATTERN = re.compile(r'^[-+]?(0|[1-9][0-9]*)\Z')
+_DECIMAL_PATTERN = re.compile(r'^[-+]?([0-9]+\.[0-9]*|\.[0-9]+|[0-9]+(?=[eE]))([eE][-+]?[0-9]+)?\Z')
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+def _csv_value(value):
+    '''
+    csv fields that look like numbers are loaded as numbers, like mongoimport does.
+    Only plain decimal numbers are converted - values like 1_000, nan, inf or 007 are kept as strings.
+    Integers outside the range of a bson 64-bit integer are loaded as doubles
+    '''
+    if _INTEGER_PATTERN.match(value):
+        number = int(value)
+        if _INT64_MIN <= number <= _INT64_MAX:
+            return number
+        return float(value)
+    if _DECIMAL_PATTERN.match(value):
+        return float(value)
+    return value
+
+
+def _read_documents(input_file, csv_file, batch_size):
+    '''
+    Generator of lists of at most batch_size documents read from a csv (with header line)
+    or json (one document per line, mongo extended json) file
+    '''
+    batch = []
+    with open(input_file, 'r') as f:
+        if csv_file:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            for row in reader:
+                batch.append(dict(zip(header, [_csv_value(value) for value in row])))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        else:
+            for line in f:
+                line = line.strip()
+                if line == '':
+                    continue
+                batch.append(json_util.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _write_batches(mongo_collection, batches, workers, upsert_keys, log_out):
+    '''
+    Write batches of documents using worker threads. Batches are handed to the threads through a bounded queue
+    so that the file is not read faster than it can be written. Write errors of a batch are logged and
+    the other batches continue
+    '''
+    batch_queue = queue.Queue(workers * 2)
+    stats = {"documents": 0, "failed": 0, "batches": 0}
+    stats_lock = threading.Lock()
+    errors = []
+
+    def write_batch(batch_number, batch):
+        try:
+            if len(upsert_keys) > 0:
+                requests = [pymongo.ReplaceOne(dict([(key, document.get(key)) for key in upsert_keys]),
+                                               document, upsert=True) for document in batch]
+                mongo_collection.bulk_write(requests, ordered=False)
+            else:
+                mongo_collection.insert_many(batch, ordered=False)
+            failed = 0
+            messages = []
+        except pymongo.errors.BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            failed = len(write_errors)
+            messages = ["batch {0} document {1}: {2}".format(batch_number, error.get('index'), error.get('errmsg'))
+                        for error in write_errors]
+        with stats_lock:
+            stats["documents"] += len(batch) - failed
+            stats["failed"] += failed
+            stats["batches"] += 1
+            for message in messages:
+                log_out.write(message + "\n")
+
+    def worker():
+        while True:
+            item = batch_queue.get()
+            if item is None:
+                return
+            try:
+                write_batch(*item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for i in range(max(int(workers), 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for batch_number, batch in enumerate(batches, 1):
+            if len(errors) > 0:
+                break
+            batch_queue.put((batch_number, batch))
+    finally:
+        for thread in threads:
+            batch_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    return stats
+
+
+def _path_getter(path):
+    '''
+    Return a function that gets the value of a dotted path (eg:- properties.city) from a document.
+    Missing fields return None
+    '''
+    keys = path.split('.')
+    if len(keys) == 1:
+        key = keys[0]
+        return lambda document: document.get(key)
+
+    def get_value(document):
+        for key in keys:
+            if isinstance(document, dict):
+                document = document.get(key)
+            elif isinstance(document, list) and key.isdigit() and int(key) < len(document):
+                document = document[int(key)]
+            else:
+                return None
+        return document
+    return get_value
+
+
+def _id_ranges(mongo_collection, partitions, query={}, samples_per_partition=20):
+    '''
+    Split the collection into partitions ranges of _id with about the same number of documents,
+    using split points taken from a random sample of the _id values.
+    mongo range queries only match _id values of the same type as the bounds, so a last range of
+    _OtherIdTypes picks up documents whose _id is of another type than the sample. The collection is read as
+    a single range if the sample has _id values of more than one type or of a type that can not be split
+    :return: list of (lower, upper) tuples. lower is inclusive, upper is exclusive and None is unbounded
+    '''
+    partitions = max(int(partitions), 1)
+    if partitions == 1:
+        return [(None, None)]
+
+    pipeline = []
+    if query:
+        pipeline.append({'$match': query})
+    pipeline.append({'$sample': {'size': partitions * samples_per_partition}})
+    pipeline.append({'$project': {'_id': 1}})
+    sample_ids = [document['_id'] for document in mongo_collection.aggregate(pipeline, allowDiskUse=True)]
+
+    id_types = set([_id_type(sample_id) for sample_id in sample_ids])
+    if len(id_types) != 1 or None in id_types:
+        return [(None, None)]
+    sample_ids.sort()
+
+    split_points = []
+    for index in range(1, partitions):
+        split_point = sample_ids[len(sample_ids) * index // partitions]
+        if len(split_points) == 0 or split_point > split_points[-1]:
+            split_points.append(split_point)
+    if len(split_points) == 0:
+        return [(None, None)]
+
+    id_ranges = list(zip([None] + split_points, split_points + [None]))
+    id_ranges.append((_OtherIdTypes(id_types.pop()), None))
+    return id_ranges
+
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+
+def _id_type(value):
+    '''
+    $type aliases of the bson types that mongo compares value with in a range query.
+    None for values that are not split on
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, bson.int64.Int64, bson.decimal128.Decimal128)):
+        return ('number',)
+    if isinstance(value, _STRING_TYPES):
+        return ('string', 'symbol')
+    if isinstance(value, bson.ObjectId):
+        return ('objectId',)
+    if isinstance(value, dt.datetime):
+        return ('date',)
+    return None
+
+
+class _OtherIdTypes():
+    '''
+    Lower bound of the range of documents whose _id is not of any of the id_types
+    '''
+    def __init__(self, id_types):
+        self.id_types = list(id_types)
+
+    def __repr__(self):
+        return "_id not of type " + ", ".join(self.id_types)
+
+
+def _id_range_filter(query, lower, upper):
+    if isinstance(lower, _OtherIdTypes):
+        id_filter = {'$not': {'$type': lower.id_types}}
+    else:
+        id_filter = {}
+        if lower is not None:
+            id_filter['$gte'] = lower
+        if upper is not None:
+            id_filter['$lt'] = upper
+    if len(id_filter) == 0:
+        return query
+    if query:
+        return {'$and': [query, {'_id': id_filter}]}
+    return {'_id': id_filter}
+
+
+def _csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json_util.dumps(value)
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    return value
+
+
+def _write_documents(cursor, file_name, field_list, getters, write_header=False, rows_per_write=1000):
+    '''
+    Write the documents of a cursor to a csv file (when field_list is given) or a json file
+    :return: number of documents written
+    '''
+    document_count = 0
+    with open(file_name, 'w') as f:
+        if len(field_list) > 0:
+            writer = csv.writer(f, lineterminator='\n')
+            if write_header:
+                writer.writerow(field_list)
+            rows = []
+            for document in cursor:
+                rows.append([_csv_field(getter(document)) for getter in getters])
+                if len(rows) >= rows_per_write:
+                    writer.writerows(rows)
+                    document_count += len(rows)
+                    rows = []
+            writer.writerows(rows)
+            document_count += len(rows)
+        else:
+            lines = []
+            for document in cursor:
+                lines.append(json_util.dumps(document) + '\n')
+                if len(lines) >= rows_per_write:
+                    f.write(''.join(lines))
+                    document_count += len(lines)
+                    lines = []
+            f.write(''.join(lines))
+            document_count += len(lines)
+    return document_count
+
+
+def _run_threads(function, count):
+    '''
+    Call function(index) for index 0 to count - 1 in separate threads
+    :return: list of the values returned. The first error is raised after all the threads finish
+    '''
+    results = [None] * count
+    errors = []
+
+    def run(index):
+        try:
+            results[index] = function(index)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        copy_stream.reraise(errors[0])
+    return results
+
+
+class _FieldPlan():
+    '''
+    mixpanel_fields and field_mapping of export_mixpanel_query_results compiled into one getter per output column.
+    properties.<name> fields are read from the properties of the event, other fields from the top of the document
+    and the json_field "id" is the _id of the event.
+    When projected is True the documents come from the $project stage of pipeline() where every field has
+    already been flattened to f<n>
+    '''
+    def __init__(self, mixpanel_fields, field_mapping, constant_fields={}, file_delimiter=",", projected=True):
+        self.paths = {"id": "_id"}
+        for key in mixpanel_fields:
+            if key.startswith("properties"):
+                self.paths[str(key)] = "properties." + key.split('.')[1]
+            else:
+                self.paths[str(key)] = str(key)
+        self.aliases = dict([(json_field, "f" + str(index))
+                             for index, json_field in enumerate(sorted(self.paths))])
+        self.cleanup = _cleanup_function(file_delimiter)
+
+        self.column_names = []
+        self.getters = []
+        self.constants = []
+        for config_data in field_mapping:
+            self.column_names.append(str(config_data['gp_column_name']))
+            if config_data['gp_value_is_constant']:
+                self.getters.append(None)
+                self.constants.append(constant_fields.get(config_data['gp_column_name']))
+            else:
+                json_field = config_data['json_field']
+                if json_field not in self.paths:
+                    getter = None
+                elif projected:
+                    getter = _path_getter(self.aliases[json_field])
+                else:
+                    getter = _path_getter(self.paths[json_field])
+                self.getters.append(getter)
+                self.constants.append(None)
         return
 
+    def pipeline(self, query):
+        '''
+        aggregation pipeline that filters the events and flattens the mapped fields
+        '''
+        projection = dict([(alias, "$" + self.paths[json_field]) for json_field, alias in self.aliases.items()])
+        projection["_id"] = 0
+        pipeline = []
+        if query:
+            pipeline.append({"$match": query})
+        pipeline.append({"$project": projection})
+        return pipeline
+
+    def values(self, document):
+        '''
+        python values of the output columns. Missing fields are None
+        '''
+        return [getter(document) if getter is not None else constant
+                for getter, constant in zip(self.getters, self.constants)]
+
+    def text_row(self, document):
+        '''
+        output columns as text. Delimiters and line breaks are removed from field values and None is written as
+        an empty string
+        '''
+        row = []
+        cleanup = self.cleanup
+        for getter, constant in zip(self.getters, self.constants):
+            if getter is None:
+                value = "" if constant is None else str(constant)
+            else:
+                value = getter(document)
+                if value is None:
+                    row.append("")
+                    continue
+                value = cleanup(value) if isinstance(value, _STRING_TYPES) else str(value)
+            row.append("" if value == "None" else value)
+        return row
+
+
+def _cleanup_function(file_delimiter):
+    '''
+    Return a function that removes the delimiter and line breaks from a string
+    '''
+    ''' python 2 str.translate does not take a dict, so python 2 always uses replace '''
+    if len(file_delimiter) == 1 and sys.version_info.major == 3:
+        table = dict([(ord(char), None) for char in (file_delimiter, '\r', '\n')])
+        return lambda value: value.translate(table)
+    return lambda value: value.replace(file_delimiter, "").replace('\r', '').replace('\n', '')
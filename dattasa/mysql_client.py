@@ -1,10 +1,26 @@
 import pymysql
+import pymysql.cursors
+from pymysql.constants import FIELD_TYPE
 import sqlalchemy
 from sqlalchemy import exc
 import time
 import datetime as dt
 import subprocess
 import sys, os
+import re
+import csv
+import threading
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from dattasa import connection_pool
+from dattasa import sql_utils
+from dattasa import copy_stream
+from dattasa import file_processor
 
 
 class MySQLClient():
@@ -83,6 +99,49 @@ class MySQLClient():
 
         return self.conn
 
+    def __connect(self, connect_timeout=10, local_infile=False):
+        '''
+        Open a new pymysql connection for the connection pool and for loads that need their own connections
+        '''
+        db_credentials = self.db_credentials[self.db_host]
+        connect_args = dict(host=db_credentials['host'],
+                            port=db_credentials['port'],
+                            user=db_credentials['user'],
+                            connect_timeout=connect_timeout,
+                            local_infile=local_infile)
+        if 'password' in db_credentials:
+            connect_args['password'] = db_credentials['password']
+        if 'ssl_params' in db_credentials:
+            connect_args['ssl'] = db_credentials['ssl_params']
+        return pymysql.connect(**connect_args)
+
+    def get_connection_pool(self, connect_timeout=10):
+        '''
+        Return the process wide connection pool for db_host.
+        Pool size and timeouts are read from pool_* settings of db_host in the config file
+        '''
+        def validate(conn):
+            conn.ping(reconnect=False)
+
+        def reset(conn):
+            conn.rollback()
+
+        return connection_pool.get_pool(self.db_host, self.db_credentials,
+                                        lambda: self.__connect(connect_timeout),
+                                        validate, reset, self.config_file)
+
+    @contextmanager
+    def pooled_connection(self, connect_timeout=10, timeout=None):
+        '''
+        Borrow a pymysql connection from the connection pool of db_host and return it when done.
+        Any open transaction is rolled back when the connection goes back to the pool, so commit inside the block.
+        :param connect_timeout: timeout used while opening new connections
+        :param timeout: seconds to wait for a free connection in the pool
+        :return: pymysql connection
+        '''
+        with self.get_connection_pool(connect_timeout).connection(timeout) as conn:
+            yield conn
+
     def get_db_cursor(self, verbose=False, connect_timeout=10):
         '''
         uses the credentials in config_yaml_file for db_host while initiating database connection.
@@ -155,6 +214,139 @@ class MySQLClient():
     def get_results(self):
         return self.cur.fetchall()
 
+    def stream_query(self, sql, batch_size=10000, row_format='tuple'):
+        '''
+        Generator that runs the sql using an unbuffered cursor (SSCursor) and yields the results in batches
+        instead of fetching all the rows into memory. The cursor is closed when the generator is exhausted
+        or closed early. Note that mysql still sends the remaining rows when the cursor is closed early.
+        pymysql connection must be established prior to calling this function
+        :param sql:
+        :param batch_size: number of rows in each batch that is yielded
+        :param row_format: tuple (list of tuples), dict (list of dicts) or dataframe (pandas DataFrame)
+        :return: generator of row batches
+        '''
+        if row_format not in ('tuple', 'dict', 'dataframe'):
+            raise Exception('row_format must be one of tuple, dict or dataframe')
+        if row_format == 'dataframe':
+            import pandas as pd
+
+        if row_format == 'dict':
+            cursor = self.conn.cursor(pymysql.cursors.SSDictCursor)
+        else:
+            cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+
+        try:
+            cursor.execute(sql)
+            columns = None
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if len(batch) == 0:
+                    break
+                if row_format == 'dataframe':
+                    if columns is None:
+                        columns = [column[0] for column in cursor.description]
+                    yield pd.DataFrame.from_records(list(batch), columns=columns)
+                else:
+                    yield list(batch)
+        finally:
+            try:
+                cursor.close()
+            except pymysql.MySQLError:
+                pass
+
+        return
+
+    def copy_to_stream(self, sql, stream, delimiter='\t', null_string='\\N', batch_size=10000,
+                       key_column=None, key_range=(None, None), page_size=100000, null_keys=None):
+        '''
+        Stream the results of sql to stream as rows in postgres COPY text format using an unbuffered cursor.
+        Rows are added to stream batch_size rows at a time with stream.put so that several
+        readers can share a copy_stream.BoundedPipe.
+        With key_column the rows are read in pages of page_size ordered on key_column (keyset pagination),
+        each page starting after the last key of the previous page, optionally limited to key_range.
+        Rows with a NULL key_column are read separately in a single query when null_keys is set.
+        key_column must be unique and part of the results of sql. It is matched on its name in the results,
+        so use the alias for columns that are renamed in sql.
+        pymysql connection must be established prior to calling this function
+        :param sql:
+        :param stream: copy_stream.BoundedPipe
+        :param delimiter:
+        :param null_string:
+        :param batch_size:
+        :param key_column: unique column used for keyset pagination
+        :param key_range: (lower, upper) of key_column. lower is inclusive, upper is exclusive and None is unbounded
+        :param page_size: rows in each page
+        :param null_keys: read the rows with a NULL key_column. Default is True when key_range is (None, None).
+        When key_range is split between several readers set it for only one of them
+        :return: number of rows written
+        '''
+        sql = sql.strip().rstrip(';')
+        if key_column is None:
+            return self.__copy_query_to_stream(sql, stream, delimiter, null_string, batch_size)[0]
+
+        key_name = sql_utils.output_column_name(key_column)
+        key_reference = "dattasa_src.`" + key_name + "`"
+        lower, upper = key_range
+        if null_keys is None:
+            null_keys = lower is None and upper is None
+
+        row_count = 0
+        if null_keys:
+            null_sql = "SELECT * FROM (" + sql + ") dattasa_src WHERE " + key_reference + " IS NULL"
+            row_count += self.__copy_query_to_stream(null_sql, stream, delimiter, null_string, batch_size)[0]
+
+        last_key = None
+        while True:
+            conditions = [key_reference + " IS NOT NULL"]
+            if last_key is not None:
+                conditions.append(key_reference + " > " + sql_utils.sql_literal(last_key))
+            elif lower is not None:
+                conditions.append(key_reference + " >= " + sql_utils.sql_literal(lower))
+            if upper is not None:
+                conditions.append(key_reference + " < " + sql_utils.sql_literal(upper))
+            page_sql = "SELECT * FROM (" + sql + ") dattasa_src WHERE " + " AND ".join(conditions) + \
+                       " ORDER BY " + key_reference + " LIMIT " + str(int(page_size))
+
+            page_rows, last_key = self.__copy_query_to_stream(page_sql, stream, delimiter, null_string,
+                                                              batch_size, key_name)
+            row_count += page_rows
+            ''' a NULL last key would restart the paging from the beginning of the range '''
+            if page_rows < page_size or last_key is None:
+                break
+
+        return row_count
+
+    def __copy_query_to_stream(self, sql, stream, delimiter, null_string, batch_size, key_name=None):
+        '''
+        :return: number of rows written and the value of the key_name column in the last row
+        '''
+        cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+        row_count = 0
+        last_key = None
+        try:
+            cursor.execute(sql)
+            key_index = None
+            if key_name is not None:
+                column_names = [column[0] for column in cursor.description]
+                if key_name not in column_names:
+                    raise Exception('key column ' + key_name + ' is not one of the columns in the results of sql')
+                key_index = column_names.index(key_name)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                stream.put(copy_stream.encode_copy_columns(list(zip(*rows)), delimiter, null_string))
+                row_count += len(rows)
+                if key_index is not None:
+                    last_key = rows[-1][key_index]
+        finally:
+            try:
+                cursor.close()
+            except pymysql.MySQLError:
+                pass
+
+        return row_count, last_key
+
     def close_connection(self):
         self.conn.close()
         return None
@@ -245,7 +437,84 @@ class MySQLClient():
         return results
 
     def export_sql_results(self, sql_file, log_file, output_file,
-                           output_file_delimited=False, delimiter=','):
+                           output_file_delimited=False, delimiter=',', compress=False, batch_size=10000,
+                           use_mysql_cli=False):
+        '''
+        The function takes a file as input and will run the SQL using the established pymysql connection.
+        Results of every statement that returns rows are streamed with an unbuffered cursor (SSCursor) into
+        output_file in a single pass, in the same format as the mysql client in batch mode (mysql -B):
+        a header line, values separated by delimiter without quotes and NULL written as NULL.
+        output_file is always created, even if no statement returns rows.
+        Set use_mysql_cli=True to run the mysql command line client instead
+        pymysql connection must be established prior to calling this function
+        :param sql_file:
+        :param log_file:
+        :param output_file:
+        :param output_file_delimited: use delimiter between the columns. Default is a tab
+        :param delimiter:
+        :param compress: gzip the output file
+        :param batch_size: rows fetched and written at a time
+        :param use_mysql_cli:
+        :return: number of rows exported
+        '''
+        if use_mysql_cli:
+            return self.__run_mysql_cli(sql_file, log_file, output_file, output_file_delimited, delimiter)
+
+        with open(sql_file, 'r') as f:
+            statements = sql_utils.split_sql_statements(f.read(), dialect='mysql')
+        if len(statements) == 0:
+            raise Exception('no sql statements found in ' + sql_file)
+        if not output_file_delimited:
+            delimiter = '\t'
+
+        log_out = open(log_file, 'a')
+        start = time.time()
+        print("Started: " + sql_file + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write("Started: " + sql_file + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        row_count = 0
+        cursor = None
+        ''' without decoders pymysql returns every value as the text sent by the server, which is what mysql prints '''
+        decoders = self.conn.decoders
+        self.conn.decoders = {}
+        try:
+            with file_processor.open_text_file(output_file, 'w', compress) as out_file:
+                for statement in statements:
+                    cursor = self.conn.cursor(pymysql.cursors.SSCursor)
+                    cursor.execute(statement)
+                    if cursor.description is not None:
+                        row_count += _write_batch_rows(cursor, out_file, delimiter, batch_size)
+                    cursor.close()
+            self.conn.commit()
+
+        except pymysql.MySQLError as e:
+            print("Error while processing " + sql_file)
+            print(e, e.args)
+            log_out.write("error message: {0}".format(e) + "\n")
+            log_out.close()
+            if cursor is not None:
+                try:
+                    cursor.close()
+                except pymysql.MySQLError:
+                    pass
+            raise Exception('mysql execution failed - Error while running sql')
+        finally:
+            self.conn.decoders = decoders
+
+        end = time.time()
+        print("Ended: " + sql_file + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write(str(row_count) + " rows exported to " + output_file + "\n")
+        log_out.write("Ended: " + sql_file + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        total_time = (end - start) * 1000
+        print("Total time taken to run: " + str(total_time) + " ms \n")
+        log_out.write("Total time taken to run: " + str(total_time) + " ms \n")
+        log_out.close()
+
+        return row_count
+
+    def __run_mysql_cli(self, sql_file, log_file, output_file,
+                        output_file_delimited=False, delimiter=','):
 
         sql_in = open(sql_file, 'r')
         results_out = open(output_file, 'a')
@@ -336,20 +605,184 @@ class MySQLClient():
 
         return
 
-    def load_csv_to_table(self, data_file, delimiter, schema_name, table_name):
+    def export_table_snapshot(self, schema_name, table_name, output_file, log_file, workers=4, key_column=None,
+                              columns='*', where_clause=None, delimiter=',', compress=False, batch_size=10000,
+                              merge_shards=True, lock_mode='flush'):
+        '''
+        Export a table to csv using workers connections that all read the same consistent snapshot.
+        While a short lock blocks writes to the table (FLUSH TABLES ... WITH READ LOCK, or LOCK TABLES ... READ
+        with lock_mode='lock'), every worker connection runs START TRANSACTION WITH CONSISTENT SNAPSHOT and
+        the lock is released as soon as all the snapshots are open.
+        The table is split into ranges of key_column (primary key by default) with sql_utils.partition_predicates
+        and the ranges are read at the same time with unbuffered cursors into the shard files of
+        copy_stream.export_shards.
+        The files are csv with a header line, values quoted only when needed and NULL written as an empty string.
+        Snapshots are only consistent for InnoDB tables
+        :param schema_name:
+        :param table_name:
+        :param output_file:
+        :param log_file:
+        :param workers: number of connections reading at the same time
+        :param key_column: single numeric or date column used to split the table. Default is the primary key
+        :param columns: columns to export
+        :param where_clause: optional filter applied to every range
+        :param delimiter:
+        :param compress: gzip the files
+        :param batch_size: rows fetched and written at a time
+        :param merge_shards: merge the shard files into output_file
+        :param lock_mode: flush, lock or None to open the snapshots without locking the table
+        :return: list of files written
+        '''
+        if lock_mode not in ('flush', 'lock', None):
+            raise Exception('lock_mode must be one of flush, lock or None')
+        table = schema_name + '.' + table_name
+        if key_column is None:
+            key_column = self.__get_primary_key(schema_name, table_name)
+
+        log_out = open(log_file, 'a')
+        start = time.time()
+        print("Started snapshot export of " + table + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write("Started snapshot export of " + table + " at " +
+                      str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        workers = max(int(workers), 1)
+        connections = []
+        row_counts = []
+        try:
+            ''' connections are added one at a time so that the ones already open are closed if a connect fails '''
+            for i in range(workers):
+                connections.append(self.__connect())
+            self.__open_snapshots(connections, table, lock_mode)
+
+            cursor = connections[0].cursor()
+            cursor.execute(sql_utils.select_sql(table, "MIN({0}), MAX({0})".format(key_column), [where_clause]))
+            key_range = cursor.fetchone()
+            cursor.close()
+            predicates = sql_utils.partition_predicates(key_column, workers, 'range', key_range[0], key_range[1])
+
+            def export_range(index, shard_file, header):
+                cursor = connections[index].cursor(pymysql.cursors.SSCursor)
+                cursor.execute(sql_utils.select_sql(table, columns, [predicates[index], where_clause]))
+                with file_processor.open_text_file(shard_file, 'w', compress) as out_file:
+                    row_count = _write_csv_rows(cursor, out_file, delimiter, batch_size, header)
+                cursor.close()
+                return row_count
+
+            output_files, row_counts = copy_stream.export_shards(export_range, output_file, len(predicates),
+                                                                 merge_shards, log_out)
+
+        except pymysql.MySQLError as e:
+            print("Error while exporting " + table)
+            print(e, e.args)
+            log_out.write("error message: {0}".format(e) + "\n")
+            log_out.close()
+            raise Exception('mysql execution failed - Error while exporting ' + table)
+        except Exception as e:
+            log_out.write("error message: {0}".format(e) + "\n")
+            log_out.close()
+            raise
+        finally:
+            for conn in connections:
+                try:
+                    conn.rollback()
+                    conn.close()
+                except pymysql.MySQLError:
+                    pass
+
+        end = time.time()
+        elapsed = max(end - start, 0.001)
+        summary = "{0} rows exported from {1} using {2} ranges, {3:.0f} rows/sec".format(
+            sum(row_counts), table, len(row_counts), sum(row_counts) / elapsed)
+        print(summary)
+        log_out.write(summary + "\n")
+        log_out.write("Ended snapshot export of " + table + " at " +
+                      str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.close()
+
+        return output_files
+
+    def __open_snapshots(self, connections, table, lock_mode):
+        '''
+        Start a consistent snapshot transaction on every connection while writes to table are blocked,
+        so that all the connections see the table at the same point in time
+        '''
+        lock_conn = None
+        try:
+            if lock_mode is not None:
+                ''' LOCK TABLES ends when the session starts a transaction, so the lock is held by its own session '''
+                lock_conn = self.__connect()
+                cursor = lock_conn.cursor()
+                if lock_mode == 'flush':
+                    cursor.execute("FLUSH TABLES " + table + " WITH READ LOCK")
+                else:
+                    cursor.execute("LOCK TABLES " + table + " READ")
+                cursor.close()
+
+            for conn in connections:
+                cursor = conn.cursor()
+                cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+                cursor.close()
+        finally:
+            if lock_conn is not None:
+                try:
+                    cursor = lock_conn.cursor()
+                    cursor.execute("UNLOCK TABLES")
+                    cursor.close()
+                finally:
+                    lock_conn.close()
+        return
+
+    def __get_primary_key(self, schema_name, table_name):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        SELECT column_name
+        FROM information_schema.key_column_usage
+        WHERE table_schema = %s AND table_name = %s AND constraint_name = 'PRIMARY'
+        ORDER BY ordinal_position
+        """, (schema_name, table_name))
+        key_columns = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        if len(key_columns) != 1:
+            raise Exception(schema_name + '.' + table_name + ' does not have a single column primary key. '
+                            'key_column is needed to split the table')
+        return key_columns[0]
+
+    def load_csv_to_table(self, data_file, delimiter, schema_name, table_name, load_mode='server',
+                          workers=4, disable_keys=False, batch_rows=10000, null_string='\\N'):
         '''
         The function takes input file, file delimiter and a connection as input
         and loads the data into the table. File has to be in csv format and delimited.
         target table must be empty or will be truncated prior to load
         pymysql connection must be established prior to calling this function
+        load_mode -
+            server : LOAD DATA INFILE. data_file must be on the database host
+            local  : LOAD DATA LOCAL INFILE. data_file is streamed from this machine (local_infile must be
+                     enabled on the server)
+            insert : rows are sent as multi-row INSERT statements sized to max_allowed_packet by workers
+                     connections at the same time. Works on managed mysql where files can not be loaded
         :param data_file:
         :param delimiter:
         :param conn:
         :param schema_name:
         :param table_name:
-        :return:
+        :param load_mode: server, local or insert
+        :param workers: insert mode only. number of connections inserting at the same time
+        :param disable_keys: disable non unique indexes (and unique / foreign key checks in insert mode) during
+        the load and rebuild them after
+        :param batch_rows: insert mode only. rows committed together by a worker
+        :param null_string: insert mode only. fields with this value are loaded as NULL
+        :return: number of rows loaded in local and insert modes
         '''
+        if load_mode not in ('server', 'local', 'insert'):
+            raise Exception('load_mode must be one of server, local or insert')
+        table = schema_name + '.' + table_name
+        if load_mode != 'server':
+            return self.__client_side_load(data_file, delimiter, table, load_mode, workers, disable_keys,
+                                           batch_rows, null_string)
 
+        if disable_keys:
+            self.__alter_keys(table, "DISABLE")
         try:
             start = time.time()
             table = schema_name + '.' + table_name
@@ -381,5 +814,243 @@ class MySQLClient():
         except Exception as e:
             print("error message: {0}".format(e))
             cursor.close()
+        finally:
+            if disable_keys:
+                self.__alter_keys(table, "ENABLE")
+
+        return
+
+    def __client_side_load(self, data_file, delimiter, table, load_mode, workers, disable_keys,
+                           batch_rows, null_string):
+        '''
+        Load data_file from this machine with LOAD DATA LOCAL INFILE or parallel multi-row inserts
+        '''
+        start = time.time()
+        print("Started " + load_mode + " load of " + data_file + " into " + table + ": " +
+              str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        if disable_keys:
+            self.__alter_keys(table, "DISABLE")
+        try:
+            if load_mode == 'local':
+                conn = self.__connect(local_infile=True)
+                try:
+                    cursor = conn.cursor()
+                    row_count = cursor.execute("""
+                    LOAD DATA LOCAL INFILE '{data_file}'
+                    INTO TABLE {table}
+                    FIELDS TERMINATED BY '{delimiter}'
+                    ENCLOSED BY '"'
+                    LINES TERMINATED BY '\r\n'
+                    IGNORE 1 LINES;
+                    """.format(data_file=os.path.abspath(data_file), table=table, delimiter=delimiter))
+                    conn.commit()
+                    cursor.close()
+                finally:
+                    conn.close()
+            else:
+                row_count = self.__parallel_insert(data_file, delimiter, table, workers, disable_keys,
+                                                   batch_rows, null_string)
+        except Exception:
+            if disable_keys:
+                try:
+                    self.__alter_keys(table, "ENABLE")
+                except pymysql.MySQLError as e:
+                    print("Unable to enable keys of " + table + ". Run ALTER TABLE " + table + " ENABLE KEYS")
+                    print(e, e.args)
+            raise
+        if disable_keys:
+            self.__alter_keys(table, "ENABLE")
+
+        end = time.time()
+        print(str(row_count) + " rows loaded into " + table)
+        print("Ended load: " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        print("Overall run time:")
+        print(str((end - start) * 1000) + ' ms')
 
+        return row_count
+
+    def __alter_keys(self, table, action):
+        '''
+        Run ALTER TABLE ... DISABLE / ENABLE KEYS on a connection of its own. Errors are raised
+        '''
+        conn = self.__connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("ALTER TABLE " + table + " " + action + " KEYS")
+            cursor.close()
+        finally:
+            conn.close()
         return
+
+    def __parallel_insert(self, data_file, delimiter, table, workers, disable_keys, batch_rows, null_string):
+        '''
+        Read data_file in batches of batch_rows rows and insert them using workers connections.
+        pymysql executemany folds the rows of a batch into multi-row INSERT statements of up to
+        max_stmt_length bytes, which is set from max_allowed_packet of the server
+        '''
+        workers = max(int(workers), 1)
+        batch_queue = queue.Queue(workers * 2)
+        errors = []
+        counts = []
+        counts_lock = threading.Lock()
+
+        def insert_batches(conn, max_stmt_length):
+            try:
+                cursor = conn.cursor()
+                cursor.max_stmt_length = max_stmt_length
+                if disable_keys:
+                    cursor.execute("SET unique_checks = 0, foreign_key_checks = 0")
+                while True:
+                    batch = batch_queue.get()
+                    if batch is None:
+                        break
+                    if len(errors) > 0:
+                        continue
+                    insert_sql = "INSERT INTO " + table + " VALUES (" + ", ".join(["%s"] * len(batch[0])) + ")"
+                    cursor.executemany(insert_sql, batch)
+                    conn.commit()
+                    with counts_lock:
+                        counts.append(len(batch))
+                cursor.close()
+            except Exception as e:
+                errors.append(e)
+                ''' keep taking batches so that the reader does not block on a full queue '''
+                while batch_queue.get() is not None:
+                    pass
+            finally:
+                conn.close()
+
+        ''' the workers close their connections, until they start the connections are closed here on errors '''
+        connections = []
+        try:
+            for i in range(workers):
+                connections.append(self.__connect())
+            cursor = connections[0].cursor()
+            cursor.execute("SELECT @@max_allowed_packet")
+            max_allowed_packet = int(cursor.fetchone()[0])
+            cursor.close()
+        except Exception:
+            for conn in connections:
+                conn.close()
+            raise
+        ''' leave room for the packet header and the INSERT INTO ... VALUES prefix '''
+        max_stmt_length = max(max_allowed_packet - 65536, 65536)
+
+        threads = [threading.Thread(target=insert_batches, args=(conn, max_stmt_length)) for conn in connections]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            with file_processor.open_text_file(data_file, 'r') as f:
+                reader = csv.reader(f, delimiter=delimiter, quotechar='"')
+                next(reader, None)
+                batch = []
+                for row in reader:
+                    if len(errors) > 0:
+                        break
+                    batch.append([None if value == null_string else value for value in row])
+                    if len(batch) >= batch_rows:
+                        batch_queue.put(batch)
+                        batch = []
+                if len(batch) > 0 and len(errors) == 0:
+                    batch_queue.put(batch)
+        finally:
+            for thread in threads:
+                batch_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if len(errors) > 0:
+            print("error message: {0}".format(errors[0]))
+            raise Exception('load to mysql failed - ' + str(sum(counts)) + ' rows were committed before the error')
+
+        return sum(counts)
+
+
+if sys.version_info.major == 3:
+    def _native_str(value):
+        '''
+        str of a text value for files opened with file_processor.open_text_file. bytes are decoded as utf-8
+        '''
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        return value
+else:
+    def _native_str(value):
+        '''
+        str of a text value for files opened with file_processor.open_text_file. unicode is encoded as utf-8
+        '''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+
+_BATCH_ESCAPES = {'\0': '\\0', '\t': '\\t', '\n': '\\n', '\\': '\\\\'}
+_BATCH_ESCAPE_PATTERN = re.compile(r'[\0\t\n\\]')
+
+
+def _write_batch_rows(cursor, out_file, delimiter='\t', batch_size=10000):
+    '''
+    Write the rows of an executed cursor the way the mysql client writes them in batch mode (mysql -B).
+    A header line with the column names, values separated by delimiter without quotes, NULL written as NULL
+    and tab, new line, backslash and NUL characters escaped with a backslash.
+    Values must be the text sent by the server (cursor of a connection without decoders)
+    :return: number of rows written
+    '''
+    def escape(value):
+        if value is None:
+            return 'NULL'
+        value = _native_str(value)
+        return _BATCH_ESCAPE_PATTERN.sub(lambda match: _BATCH_ESCAPES[match.group(0)], value)
+
+    out_file.write(delimiter.join([escape(column[0]) for column in cursor.description]) + '\n')
+    row_count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        out_file.write(''.join([delimiter.join([escape(value) for value in row]) + '\n' for row in rows]))
+        row_count += len(rows)
+    return row_count
+
+
+_BINARY_FIELD_TYPES = (FIELD_TYPE.TINY_BLOB, FIELD_TYPE.MEDIUM_BLOB, FIELD_TYPE.LONG_BLOB, FIELD_TYPE.BLOB,
+                       FIELD_TYPE.STRING, FIELD_TYPE.VAR_STRING, FIELD_TYPE.BIT, FIELD_TYPE.GEOMETRY)
+
+
+def _write_csv_rows(cursor, out_file, delimiter=',', batch_size=10000, header=True):
+    '''
+    Write the rows of an executed cursor to out_file with a csv writer, fetching batch_size rows at a time.
+    Binary values are decoded as utf-8 (on python 2 text values are encoded as utf-8 for the csv module)
+    :return: number of rows written
+    '''
+    writer = csv.writer(out_file, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+    if header:
+        writer.writerow([_native_str(column[0]) for column in cursor.description])
+
+    ''' only columns that can hold bytes need to be converted, other rows go to the writer as they are '''
+    if sys.version_info.major == 3:
+        binary_columns = [index for index, column in enumerate(cursor.description)
+                          if column[1] in _BINARY_FIELD_TYPES]
+    else:
+        binary_columns = list(range(len(cursor.description)))
+
+    row_count = 0
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if len(rows) == 0:
+            break
+        if len(binary_columns) > 0:
+            rows = [_decode_binary_values(row, binary_columns) for row in rows]
+        writer.writerows(rows)
+        row_count += len(rows)
+    return row_count
+
+
+def _decode_binary_values(row, binary_columns):
+    row = list(row)
+    for index in binary_columns:
+        row[index] = _native_str(row[index])
+    return row
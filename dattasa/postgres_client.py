@@ -1,4 +1,5 @@
 import psycopg2
+import psycopg2.extras
 import sqlalchemy
 from sqlalchemy import exc
 import time
@@ -6,6 +7,27 @@ import datetime as dt
 import sys, os
 import subprocess
 import shutil
+import itertools
+import uuid
+import re
+import io
+from contextlib import contextmanager
+from dattasa import connection_pool
+from dattasa import sql_utils
+from dattasa import copy_stream
+
+
+class SQLExecutionError(Exception):
+    '''
+    Raised when a statement of a sql script fails. statement_index starts from 1
+    '''
+    def __init__(self, statement_index, statement, pgerror='', pgcode=None):
+        self.statement_index = statement_index
+        self.statement = statement
+        self.pgerror = pgerror
+        self.pgcode = pgcode
+        Exception.__init__(self, 'psql execution failed - Error while running statement ' +
+                           str(statement_index) + ': ' + str(pgerror).strip())
 
 
 class PostgresClient():
@@ -79,6 +101,61 @@ class PostgresClient():
 
         return self.conn
 
+    def __connect(self, connect_timeout=10):
+        '''
+        Open a new psycopg2 connection for the connection pool.
+        Falls back to password from pgpass if no password is found in yaml file
+        '''
+        db_credentials = self.db_credentials[self.db_host]
+        if 'password' in db_credentials:
+            return psycopg2.connect(database=db_credentials['database'],
+                                    user=db_credentials['user'],
+                                    password=db_credentials['password'],
+                                    host=db_credentials['host'],
+                                    port=db_credentials['port'],
+                                    connect_timeout=connect_timeout)
+        return psycopg2.connect(database=db_credentials['database'],
+                                user=db_credentials['user'],
+                                host=db_credentials['host'],
+                                port=db_credentials['port'],
+                                connect_timeout=connect_timeout)
+
+    def get_connection_pool(self, connect_timeout=10):
+        '''
+        Return the process wide connection pool for db_host.
+        Pool size and timeouts are read from pool_* settings of db_host in the config file
+        '''
+        def validate(conn):
+            if conn.closed:
+                raise Exception('connection closed')
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+
+        def reset(conn):
+            if conn.closed:
+                raise Exception('connection closed')
+            conn.rollback()
+
+        return connection_pool.get_pool(self.db_host, self.db_credentials,
+                                        lambda: self.__connect(connect_timeout),
+                                        validate, reset, self.config_file)
+
+    @contextmanager
+    def pooled_connection(self, connect_timeout=10, timeout=None):
+        '''
+        Borrow a psycopg2 connection from the connection pool of db_host and return it when done.
+        Any open transaction is rolled back when the connection goes back to the pool, so commit inside the block.
+        with db.pooled_connection() as conn:
+            ...
+        :param connect_timeout: timeout used while opening new connections
+        :param timeout: seconds to wait for a free connection in the pool
+        :return: psycopg2 connection
+        '''
+        with self.get_connection_pool(connect_timeout).connection(timeout) as conn:
+            yield conn
+
     def get_db_cursor(self, verbose=False, connect_timeout=10):
         '''
         uses the credentials in config_yaml_file for db_host while initiating database connection.
@@ -156,6 +233,55 @@ class PostgresClient():
     def get_results(self):
         return self.cur.fetchall()
 
+    def stream_query(self, sql, batch_size=10000, row_format='tuple', itersize=None):
+        '''
+        Generator that runs the sql using a server side (named) cursor and yields the results in batches
+        instead of fetching all the rows into memory. The cursor is closed when the generator is exhausted
+        or closed early (eg:- break out of the for loop).
+        pyscopg2 connection must be established prior to calling this function.
+        Named cursors run inside a transaction, commit or rollback the connection once done.
+        for rows in db.stream_query("SELECT * FROM big_table", batch_size=50000):
+            ...
+        :param sql:
+        :param batch_size: number of rows in each batch that is yielded
+        :param row_format: tuple (list of tuples), dict (list of dicts) or dataframe (pandas DataFrame)
+        :param itersize: number of rows fetched from the server in each round trip. Default = batch_size
+        :return: generator of row batches
+        '''
+        if row_format not in ('tuple', 'dict', 'dataframe'):
+            raise Exception('row_format must be one of tuple, dict or dataframe')
+        if row_format == 'dataframe':
+            import pandas as pd
+
+        cursor_name = "dattasa_stream_" + uuid.uuid4().hex
+        if row_format == 'dict':
+            cursor = self.conn.cursor(name=cursor_name, cursor_factory=psycopg2.extras.RealDictCursor)
+        else:
+            cursor = self.conn.cursor(name=cursor_name)
+        cursor.itersize = itersize if itersize else batch_size
+
+        try:
+            cursor.execute(sql)
+            rows = iter(cursor)
+            columns = None
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if len(batch) == 0:
+                    break
+                if row_format == 'dataframe':
+                    if columns is None:
+                        columns = [column[0] for column in cursor.description]
+                    yield pd.DataFrame.from_records(batch, columns=columns)
+                else:
+                    yield batch
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error:
+                pass
+
+        return
+
     def rollback(self):
         self.conn.rollback()
         return None
@@ -254,7 +380,8 @@ class PostgresClient():
         '''
         The function takes a file as input and will run the SQL query using given connection
         pyscopg2 connection must be established prior to calling this function.
-        results are redirected to output_file that can be delimited
+        results are redirected to output_file that can be delimited.
+        Errors are written to log_file and raised
         :param sql_file:
         :param output_file:
         :param output_file_delimited:
@@ -262,9 +389,9 @@ class PostgresClient():
         :return: None
         '''
 
+        log_out = open(log_file, 'a')
+        cursor = None
         try:
-            log_out = open(log_file, 'a')
-
             f = open(sql_file, 'r')
             start = time.time()
             sql = s = " ".join(f.readlines())
@@ -304,16 +431,139 @@ class PostgresClient():
             print ("Unable to export!")
             print (e.pgerror)
             print (e.diag.message_detail)
-            cursor.close()
+            log_out.write("error message: {0}".format(e.pgerror or e) + "\n")
+            raise Exception('postgres execution failed - Error while exporting ' + sql_file)
         except OSError as err:
             print("OS error: " + format(err))
-            cursor.close()
-        except Exception as e:
-            print("error message: {0}".format(e))
-            cursor.close()
+            log_out.write("OS error: " + format(err) + "\n")
+            raise
+        finally:
+            if cursor is not None and not cursor.closed:
+                cursor.close()
+            log_out.close()
 
         return
 
+    def export_table_snapshot(self, schema_name, table_name, output_file, log_file, workers=4, split_mode='ctid',
+                              key_column=None, columns='*', where_clause=None, delimiter=',', merge_shards=True):
+        '''
+        Export a table to csv using workers connections that all read the same snapshot.
+        The first connection exports its snapshot with pg_export_snapshot() and the other connections attach to it
+        with SET TRANSACTION SNAPSHOT, so every connection sees the table at the same point in time.
+        The table is split into ranges of heap pages (split_mode='ctid') or of key_column (split_mode='key') and
+        the ranges are copied at the same time with COPY TO STDOUT into the shard files of copy_stream.export_shards.
+        Key ranges are made with sql_utils.partition_predicates.
+        ctid ranges are read with tid range scans on postgres 14 and later, older versions scan the whole table in
+        every connection. Greenplum is not supported as its distributed snapshots can not be exported
+        :param schema_name:
+        :param table_name:
+        :param output_file:
+        :param log_file:
+        :param workers: number of connections reading at the same time
+        :param split_mode: ctid or key
+        :param key_column: numeric or date column used to split the table when split_mode='key'
+        :param columns: columns to export
+        :param where_clause: optional filter applied to every range
+        :param delimiter:
+        :param merge_shards: merge the shard files into output_file
+        :return: list of files written
+        '''
+        if isinstance(self, GreenplumClient):
+            raise Exception('export_table_snapshot needs postgres. greenplum snapshots can not be exported')
+        if split_mode not in ('ctid', 'key'):
+            raise Exception('split_mode must be ctid or key')
+        if split_mode == 'key' and key_column is None:
+            raise Exception('key_column is needed to split ' + schema_name + '.' + table_name + ' on keys')
+        table = schema_name + '.' + table_name
+
+        log_out = open(log_file, 'a')
+        start = time.time()
+        print ("Started snapshot export of " + table + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write("Started snapshot export of " + table + " at " +
+                      str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        workers = max(int(workers), 1)
+        connections = []
+        row_counts = []
+        try:
+            for i in range(workers):
+                connections.append(self.__connect())
+            for conn in connections:
+                conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+
+            ''' the snapshot stays valid while the transaction of the first connection is open '''
+            cursor = connections[0].cursor()
+            cursor.execute("SELECT pg_export_snapshot()")
+            snapshot_id = cursor.fetchone()[0]
+            for conn in connections[1:]:
+                worker_cursor = conn.cursor()
+                worker_cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                worker_cursor.close()
+
+            if split_mode == 'ctid':
+                cursor.execute("SELECT pg_relation_size(%s::regclass) / current_setting('block_size')::int",
+                               (table,))
+                predicates = []
+                for lower, upper in sql_utils.split_key_range(0, int(cursor.fetchone()[0]), workers):
+                    page_range = []
+                    if lower is not None:
+                        page_range.append("ctid >= '(" + str(lower) + ",0)'::tid")
+                    if upper is not None:
+                        page_range.append("ctid < '(" + str(upper) + ",0)'::tid")
+                    predicates.append(" AND ".join(page_range) if len(page_range) > 0 else None)
+            else:
+                cursor.execute(sql_utils.select_sql(table, "MIN({0}), MAX({0})".format(key_column), [where_clause]))
+                key_range = cursor.fetchone()
+                predicates = sql_utils.partition_predicates(key_column, workers, 'range', key_range[0], key_range[1])
+            cursor.close()
+
+            def export_range(index, shard_file, header):
+                COPY_STATEMENT = """
+                COPY ({sql}) TO STDOUT
+                    WITH CSV {header}
+                    DELIMITER AS '{delimiter}'
+                """.format(sql=sql_utils.select_sql(table, columns, [predicates[index], where_clause]),
+                           header="HEADER" if header else "", delimiter=delimiter)
+                cursor = connections[index].cursor()
+                with open(shard_file, 'w') as out:
+                    cursor.copy_expert(COPY_STATEMENT, out)
+                row_count = cursor.rowcount
+                cursor.close()
+                return row_count
+
+            output_files, row_counts = copy_stream.export_shards(export_range, output_file, len(predicates),
+                                                                 merge_shards, log_out)
+
+        except psycopg2.Error as e:
+            print ("Unable to export " + table)
+            print (e.pgerror)
+            log_out.write("error message: {0}".format(e.pgerror or e) + "\n")
+            log_out.close()
+            raise
+        except Exception as e:
+            log_out.write("error message: {0}".format(e) + "\n")
+            log_out.close()
+            raise
+        finally:
+            for conn in connections:
+                try:
+                    conn.rollback()
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+
+        end = time.time()
+        elapsed = max(end - start, 0.001)
+        summary = "{0} rows exported from {1} using {2} ranges, {3:.0f} rows/sec".format(
+            sum(row_counts), table, len(row_counts), sum(row_counts) / elapsed)
+        print (summary)
+        log_out.write(summary + "\n")
+        log_out.write("Ended snapshot export of " + table + " at " +
+                      str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.close()
+
+        return output_files
+
     def load_csv_to_table(self, data_file, delimiter, schema_name, table_name, clear_target=False):
         '''
         The function takes input file, file delimiter and a connection as input
@@ -358,6 +608,247 @@ class PostgresClient():
 
         return
 
+    def copy_to_stream(self, sql, stream, delimiter='\t', null_string='\\N'):
+        '''
+        Run COPY (sql) TO STDOUT in text format and write the rows to stream (any file like object).
+        pyscopg2 connection must be established prior to calling this function.
+        Raises the database error if the copy fails
+        :param sql:
+        :param stream:
+        :param delimiter:
+        :param null_string:
+        :return: number of rows copied
+        '''
+        COPY_STATEMENT = """
+        COPY ({sql}) TO STDOUT
+            DELIMITER AS '{delimiter}'
+            NULL AS '{null_string}'
+        """.format(sql=sql.strip().rstrip(';'), delimiter=delimiter, null_string=null_string.replace("'", "''"))
+
+        cursor = self.conn.cursor()
+        try:
+            cursor.copy_expert(COPY_STATEMENT, stream)
+            row_count = cursor.rowcount
+        finally:
+            cursor.close()
+
+        return row_count
+
+    def copy_from_stream(self, stream, table_name, delimiter='\t', null_string='\\N',
+                         column_list=[], clear_target=False, commit=True):
+        '''
+        Load rows in text format from stream (any file like object) into table_name using COPY FROM STDIN.
+        pyscopg2 connection must be established prior to calling this function.
+        The transaction is rolled back and the database error is raised if the copy fails
+        :param stream:
+        :param table_name: schema_name.table_name
+        :param delimiter:
+        :param null_string:
+        :param column_list: load only these columns. Default is all columns
+        :param clear_target: truncate table before loading
+        :param commit: commit after loading
+        :return: number of rows loaded
+        '''
+        if len(column_list) > 0:
+            object_name = table_name + " (" + ", ".join(column_list) + ")"
+        else:
+            object_name = table_name
+
+        COPY_STATEMENT = """
+        COPY {object_name} FROM STDIN
+            DELIMITER AS '{delimiter}'
+            NULL AS '{null_string}'
+        """.format(object_name=object_name, delimiter=delimiter, null_string=null_string.replace("'", "''"))
+
+        cursor = self.conn.cursor()
+        try:
+            if clear_target:
+                cursor.execute("TRUNCATE " + table_name + ";")
+            cursor.copy_expert(COPY_STATEMENT, stream)
+            row_count = cursor.rowcount
+            if commit:
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        return row_count
+
+    def run_sql_script(self, sql, log_file, output_file, output_file_delimited=False, delimiter=',',
+                       script_name='sql script'):
+        '''
+        Run all the statements of a sql script in-process over a new psycopg2 connection that is closed at the end,
+        so every script gets a fresh session like psql. Statements run in autocommit mode like psql, so BEGIN / COMMIT in the script work as usual.
+        Rows of every statement that returns rows are appended to output_file the way psql -t writes them:
+        values separated by delimiter with NULL as an empty string if output_file_delimited (psql -A -F),
+        else aligned columns separated by | and an empty line after each result.
+        Values are written as they are, without COPY escaping. Queries are streamed using COPY TO STDOUT
+        when output_file_delimited
+        Stops at the first failing statement and raises SQLExecutionError with the statement index
+        :param sql: sql script
+        :param log_file:
+        :param output_file:
+        :param output_file_delimited:
+        :param delimiter:
+        :param script_name: name used in the log messages
+        :return:
+        '''
+        statements = sql_utils.split_sql_statements(sql)
+
+        log_out = open(log_file, 'a')
+        start = time.time()
+        print ("Started: " + script_name + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write("Started: " + script_name + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        conn = self.__connect()
+        try:
+            with open(output_file, 'a') as results_out:
+                conn.autocommit = True
+                cursor = conn.cursor()
+                ''' values are fetched as the text sent by the server, which is what psql prints '''
+                psycopg2.extensions.register_type(_raw_text_type(), cursor)
+                statement_index = 0
+                try:
+                    for statement_index, statement in enumerate(statements, 1):
+                        if output_file_delimited and _returns_rows(statement):
+                            COPY_STATEMENT = """
+                            COPY ({sql}) TO STDOUT
+                            """.format(sql=statement)
+                            copy_out = _UnescapedCopyWriter(results_out, delimiter)
+                            cursor.copy_expert(COPY_STATEMENT, copy_out)
+                            copy_out.flush()
+                        else:
+                            cursor.execute(statement)
+                            if cursor.description is not None:
+                                if output_file_delimited:
+                                    for row in cursor:
+                                        results_out.write(delimiter.join(
+                                            ['' if value is None else value for value in row]) + "\n")
+                                else:
+                                    _write_aligned_rows(cursor, results_out)
+                        log_out.write(str(cursor.statusmessage) + "\n")
+
+                except psycopg2.Error as e:
+                    raise SQLExecutionError(statement_index, statements[statement_index - 1],
+                                            e.pgerror or str(e), e.pgcode)
+                finally:
+                    cursor.close()
+
+        except SQLExecutionError as e:
+            print ("Error while processing " + script_name)
+            print ("Statement number " + str(e.statement_index) + " failed: " + str(e.pgerror))
+            log_out.write("ERROR: statement number " + str(e.statement_index) + " failed: " + str(e.pgerror) + "\n")
+            log_out.write(e.statement + "\n")
+            log_out.close()
+            raise
+        finally:
+            conn.close()
+
+        end = time.time()
+        print ("Ended: " + script_name + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+        log_out.write("Ended: " + script_name + " at " + str(dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) + "\n")
+
+        total_time = (end - start) * 1000
+        print ("Total time taken to run: " + str(total_time) + " ms \n")
+        log_out.write("Total time taken to run: " + str(total_time) + " ms \n")
+        log_out.close()
+
+        return
+
+
+_RIGHT_ALIGNED_TYPES = (20, 21, 23, 26, 28, 29, 700, 701, 790, 1700)
+
+
+def _raw_text_type():
+    '''
+    Typecaster that returns the values of all the known types as the text sent by the server
+    '''
+    return psycopg2.extensions.new_type(tuple(psycopg2.extensions.string_types.keys()), 'DATTASA_TEXT',
+                                        lambda value, cursor: value)
+
+
+def _write_aligned_rows(cursor, out_file):
+    '''
+    Write the rows of an executed cursor like psql -t in aligned mode. Numbers are right aligned,
+    other values are left aligned and the table ends with an empty line
+    '''
+    rows = [['' if value is None else value for value in row] for row in cursor.fetchall()]
+    if len(rows) > 0:
+        right_aligned = [column[1] in _RIGHT_ALIGNED_TYPES for column in cursor.description]
+        widths = [max([len(row[index]) for row in rows]) for index in range(len(right_aligned))]
+        for row in rows:
+            cells = []
+            for index, value in enumerate(row):
+                if right_aligned[index]:
+                    cells.append(value.rjust(widths[index]))
+                elif index < len(row) - 1:
+                    cells.append(value.ljust(widths[index]))
+                else:
+                    cells.append(value)
+            out_file.write(" " + " | ".join(cells) + "\n")
+    out_file.write("\n")
+    return
+
+
+class _UnescapedCopyWriter(io.TextIOBase):
+    '''
+    File like object for COPY TO STDOUT in text format. Rows are written to out_file with the COPY escapes
+    removed, values separated by delimiter and NULL as an empty string (same as psql -A)
+    '''
+    escapes = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+    def __init__(self, out_file, delimiter):
+        self.out_file = out_file
+        self.delimiter = delimiter
+        self.pending = ''
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        lines = (self.pending + data).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.out_file.write(self.delimiter.join([self.__unescape(value) for value in line.split('\t')]) + '\n')
+        return len(data)
+
+    def flush(self):
+        if self.pending != '':
+            self.write('\n')
+
+    def __unescape(self, value):
+        if value == '\\N':
+            return ''
+        if '\\' not in value:
+            return value
+        return re.sub(r'\\(.)', lambda match: self.escapes.get(match.group(1), match.group(1)), value)
+
+
+def _returns_rows(statement):
+    '''
+    True if the statement is a query that COPY (...) TO STDOUT can wrap
+    '''
+    words = statement.split(None, 1)
+    if len(words) == 0 or words[0].lower() not in ('select', 'with', 'values', 'table'):
+        return False
+    if words[0].lower() == 'select' and re.search(r'\binto\b', statement, re.IGNORECASE):
+        return False
+    return True
+
+
+def _has_psql_meta_commands(sql):
+    '''
+    psql meta commands (eg:- \\set, \\copy, \\i) can only be run by psql
+    '''
+    for line in sql.splitlines():
+        if line.strip().startswith('\\'):
+            return True
+    return False
+
 
 class GreenplumClient(PostgresClient):
     def __init__(self, config_file, db_credentials, db_host):
@@ -367,19 +858,30 @@ class GreenplumClient(PostgresClient):
         return
 
     def run_psql_file(self, sql_file, log_file, output_file,
-                      output_file_delimited=False, delimiter=','):
+                      output_file_delimited=False, delimiter=',', use_psql=False):
         '''
         The function takes a sql_file, log file, output_file and format of output_file as input
-        and will run the sql queries in the sql file using psql
-        psql uses the credentials in config_yaml_file for db_host while initiating database connection
+        and will run the sql queries in the sql file.
+        Sql files are run in-process using run_sql_script. psql is used only if use_psql is set or the file
+        has psql meta commands. psql uses the credentials in config_yaml_file for db_host while
+        initiating database connection
         This module will raise an exception if any ERROR is encountered while running the sql file
         :param sql_file:
         :param log_file:
         :param output_file:
         :param output_file_delimited:
+        :param delimiter:
+        :param use_psql: run the file using the psql client
         :return:
         '''
 
+        if not use_psql:
+            with open(sql_file, 'r') as f:
+                sql = f.read()
+            if not _has_psql_meta_commands(sql):
+                self.run_sql_script(sql, log_file, output_file, output_file_delimited, delimiter, sql_file)
+                return
+
         db_credentials = self.db_credentials
         db_host = self.db_host
 
@@ -452,19 +954,25 @@ class GreenplumClient(PostgresClient):
         return
 
     def run_psql_command(self, sql_command, log_file, output_file,
-                         output_file_delimited=False, delimiter=','):
+                         output_file_delimited=False, delimiter=',', use_psql=False):
         '''
         The function takes a sql_command, log file, output_file and format of output_file as input
-        and will run the sql command using psql
+        and will run the sql command in-process using run_sql_script (or using psql if use_psql is set)
         psql uses the credentials in config_yaml_file for db_host while initiating database connection
         This module will raise an exception if any ERROR is encountered while running the sql file
         :param sql_command:
         :param log_file:
         :param output_file:
         :param output_file_delimited:
+        :param delimiter:
+        :param use_psql: run the command using the psql client
         :return:
         '''
 
+        if not use_psql and not _has_psql_meta_commands(sql_command):
+            self.run_sql_script(sql_command, log_file, output_file, output_file_delimited, delimiter, 'sql command')
+            return
+
         db_credentials = self.db_credentials
         db_host = self.db_host
 
@@ -1,9 +1,26 @@
 import pika
 import threading
+import time
+import json
+import io
 import os
+import uuid
+import re
+import collections
+from psycopg2 import sql
+from dattasa import copy_stream
 
 
 class Producer(threading.Thread):
+    '''
+    Publishes persistent messages to rabbitmq over a single connection and channel that are opened on first use
+    and kept open until stop() or close() is called. Queues are declared once per channel.
+    The channel runs in transaction mode so a batch of messages is confirmed by the broker with a single
+    tx_commit round trip. If the connection is lost the producer reconnects and publishes the batch again.
+    Delivery is at least once - when the connection drops after the broker committed a batch but before the
+    commit reached the producer, the batch is published twice. Every message carries a message_id that stays
+    the same when it is published again, so consumers can drop duplicates.
+    '''
     def __init__(self, config_file, db_credentials, db_host):
 
         threading.Thread.__init__(self)
@@ -12,47 +29,289 @@ class Producer(threading.Thread):
         self.config_file = config_file
         self.db_credentials = db_credentials
         self.db_host = db_host
+
+        self.connection = None
+        self.channel = None
+        self.declared_queues = set()
+        self.channel_lock = threading.RLock()
         return
 
     def stop(self):
         self.stop_event.set()
+        self.close()
+        return
+
+    def get_channel(self):
+        '''
+        Return the channel of this producer, connecting if there is no open connection
+        '''
+        with self.channel_lock:
+            if self.connection is None or self.connection.is_closed or \
+                    self.channel is None or self.channel.is_closed:
+                self.close()
+                params = pika.URLParameters(get_connection_url(self.db_credentials, self.db_host))
+                params.socket_timeout = 5
+                self.connection = pika.BlockingConnection(params)  # Connect to RabbitMQ Host
+                self.channel = self.connection.channel()
+                self.channel.tx_select()
+                self.declared_queues = set()
+            return self.channel
+
+    def __declare_queue(self, channel, queue_name, auto_delete):
+        if (queue_name, auto_delete) not in self.declared_queues:
+            channel.queue_declare(queue=queue_name, durable=True,
+                                  auto_delete=auto_delete)  # Declare a queue - durable=True
+            self.declared_queues.add((queue_name, auto_delete))
         return
 
+    def __publish_batch(self, queue_name, messages, auto_delete, retries=1):
+        '''
+        Publish messages and commit them in one transaction. Uncommitted messages are discarded by the broker
+        when the connection drops, so the whole batch is published again after reconnecting. This duplicates the
+        batch if it was committed but the commit was not acknowledged. Retries use the same message ids
+        '''
+        message_ids = [uuid.uuid4().hex for message in messages]
+        with self.channel_lock:
+            attempt = 0
+            while True:
+                try:
+                    channel = self.get_channel()
+                    self.__declare_queue(channel, queue_name, auto_delete)
+                    for message, message_id in zip(messages, message_ids):
+                        channel.basic_publish(exchange='',
+                                              routing_key=queue_name,
+                                              body=message,
+                                              properties=pika.BasicProperties(
+                                                  delivery_mode=2,  # make message persistent
+                                                  message_id=message_id,
+                                                ))
+                    channel.tx_commit()
+                    return
+                except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError):
+                    self.close()
+                    attempt += 1
+                    if attempt > retries:
+                        raise
+
     def send(self, queue_name, message, auto_delete=False):
+        '''
+        Publish a single persistent message
+        :param queue_name:
+        :param message:
+        :param auto_delete:
+        :return: error message if the message could not be published
+        '''
+        return self.send_many(queue_name, [message], auto_delete)
 
-        db_credentials = self.db_credentials
-        rabbitmq_host = self.db_host
+    def send_many(self, queue_name, messages, auto_delete=False, batch_size=500):
+        '''
+        Publish persistent messages in batches of batch_size, each batch committed with one round trip
+        :param queue_name:
+        :param messages: iterable of messages
+        :param auto_delete:
+        :param batch_size:
+        :return: error message if the messages could not be published
+        '''
         exception = ""
+        batch = []
+        try:
+            for message in messages:
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    self.__publish_batch(queue_name, batch, auto_delete)
+                    batch = []
+            if len(batch) > 0:
+                self.__publish_batch(queue_name, batch, auto_delete)
+        except pika.exceptions.AMQPConnectionError as e:
+            exception = "Unable to connect to rabbitmq. error message: {0}".format(e)
+        except Exception as e:
+            exception = "Error while transfer meesage. error message: {0}".format(e)
+
+        return exception
+
+    def close(self):
+        with self.channel_lock:
+            connection = self.connection
+            self.connection = None
+            self.channel = None
+            self.declared_queues = set()
+            if connection is not None and connection.is_open:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+        return
 
-        connect_string = 'amqp://' + db_credentials[rabbitmq_host]['user'] + ':' + \
-                         db_credentials[rabbitmq_host]['password'] + '@' + \
-                         db_credentials[rabbitmq_host]['host'] + ':' + \
-                         str(db_credentials[rabbitmq_host]['port']) + '/' + \
-                         db_credentials[rabbitmq_host]['vhost'] + '/%2f'
 
-        url = os.environ.get('CLOUDAMQP_URL', connect_string)
+AUDIT_COLUMNS = ['audit_id', 'load_type', 'load_tables', 'load_description', 'load_time']
+_TABLE_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?\Z')
+
+
+class Consumer(threading.Thread):
+    '''
+    Reads the audit messages published by dag_controller.load_audit_table and writes them to the audit tables
+    in bulk. Up to prefetch_count messages are delivered without waiting for acknowledgement. Messages are
+    accumulated into a batch that is loaded with COPY (one per audit table) in a single transaction, and all the
+    messages of the batch are acknowledged with one basic_ack after the commit. If the load fails the messages
+    are returned to the queue.
+    Producer delivers at least once, so messages whose message_id is already in the batch or was loaded by this
+    consumer are acknowledged without being loaded again.
+    '''
+    def __init__(self, config_file, db_credentials, db_host):
+
+        threading.Thread.__init__(self)
+        self.stop_event = threading.Event()
+
+        self.config_file = config_file
+        self.db_credentials = db_credentials
+        self.db_host = db_host
+
+        self.connection = None
+        self.channel = None
+        self.loaded_message_ids = set()
+        self.loaded_message_order = collections.deque()
+        return
+
+    def stop(self):
+        self.stop_event.set()
+        return
+
+    def __remember_loaded(self, message_ids, max_message_ids):
+        for message_id in message_ids:
+            self.loaded_message_ids.add(message_id)
+            self.loaded_message_order.append(message_id)
+        while len(self.loaded_message_order) > max_message_ids:
+            self.loaded_message_ids.discard(self.loaded_message_order.popleft())
+        return
+
+    def connect(self, prefetch_count=1000):
+        '''
+        Open the connection and a channel that gets at most prefetch_count unacknowledged messages
+        :param prefetch_count: keep this larger than the batch size of consume_audit_records
+        :return: error message if the connection failed
+        '''
+        exception = ""
         try:
-            params = pika.URLParameters(url)
+            params = pika.URLParameters(get_connection_url(self.db_credentials, self.db_host))
             params.socket_timeout = 5
-            connection = pika.BlockingConnection(params)  # Connect to RabbitMQ Host
+            self.connection = pika.BlockingConnection(params)
+            self.channel = self.connection.channel()
+            self.channel.basic_qos(prefetch_count=prefetch_count)
         except Exception as e:
             exception = "Unable to connect to rabbitmq. error message: {0}".format(e)
 
-        if exception == "":
-            try:
-                channel = connection.channel()  # start a channel
-                channel.queue_declare(queue=queue_name , durable=True ,
-                                      auto_delete=auto_delete)  # Declare a queue - durable=True
-                channel.basic_publish(exchange='' ,
-                                      routing_key=queue_name,
-                                      body=message ,
-                                      properties=pika.BasicProperties(
-                                          delivery_mode=2,  # make message persistent
-                                        )
-                                      )
-                connection.close()
-            except Exception as e:
-                connection.close()
-                exception = "Error while transfer meesage. error message: {0}".format(e)
-
         return exception
+
+    def consume_audit_records(self, queue_name, db, column_list=AUDIT_COLUMNS, batch_size=500,
+                              batch_interval_secs=5, max_idle_secs=None, verbose=False, audit_tables=None,
+                              max_message_ids=100000):
+        '''
+        Load audit messages from queue_name into the table named in the audit_table field of each message
+        until stop() is called or no message arrives for max_idle_secs.
+        audit_table must be a table_name or schema_name.table_name (it is quoted, so names are case sensitive).
+        Messages for other tables are rejected
+        :param queue_name:
+        :param db: PostgresClient or GreenplumClient with a psycopg2 connection (get_db_conn)
+        :param column_list: message fields loaded into the audit table columns of the same name
+        :param batch_size: load after these many messages
+        :param batch_interval_secs: load after these many seconds even if the batch is not full
+        :param max_idle_secs: None=run until stop() is called
+        :param verbose:
+        :param audit_tables: list of the audit tables messages may be loaded into. None=any table
+        :param max_message_ids: number of loaded message ids remembered to drop redelivered duplicates
+        :return: number of audit records loaded
+        '''
+        channel = self.channel
+        channel.queue_declare(queue=queue_name, durable=True, auto_delete=False)
+
+        records_loaded = 0
+        batch = {}
+        batch_count = 0
+        batch_message_ids = set()
+        last_delivery_tag = None
+        batch_started = None
+        last_message = time.time()
+
+        for method, properties, body in channel.consume(queue_name, inactivity_timeout=1):
+            if method is not None:
+                last_message = time.time()
+                message_id = properties.message_id if properties is not None else None
+                if message_id is not None and \
+                        (message_id in batch_message_ids or message_id in self.loaded_message_ids):
+                    ''' duplicate of a message that is in the batch or already loaded '''
+                    channel.basic_ack(delivery_tag=method.delivery_tag)
+                    continue
+                try:
+                    data = json.loads(body)
+                    audit_table = data['audit_table']
+                    if not _TABLE_NAME_PATTERN.match(str(audit_table)):
+                        raise ValueError('invalid audit table name ' + str(audit_table))
+                    if audit_tables is not None and audit_table not in audit_tables:
+                        raise ValueError(str(audit_table) + ' is not one of the audit tables')
+                except (ValueError, KeyError) as e:
+                    print("rejecting malformed audit message. error message: {0}".format(e))
+                    channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                    continue
+                columns = batch.setdefault(audit_table, [[] for column in column_list])
+                for column, column_name in zip(columns, column_list):
+                    column.append(data.get(column_name))
+                batch_count += 1
+                if message_id is not None:
+                    batch_message_ids.add(message_id)
+                last_delivery_tag = method.delivery_tag
+                if batch_started is None:
+                    batch_started = time.time()
+
+            batch_is_due = batch_count >= batch_size or \
+                (batch_count > 0 and time.time() - batch_started >= batch_interval_secs)
+            stopping = self.stop_event.is_set() or \
+                (max_idle_secs is not None and time.time() - last_message >= max_idle_secs)
+
+            if batch_count > 0 and (batch_is_due or stopping):
+                try:
+                    for audit_table, columns in batch.items():
+                        data = copy_stream.encode_copy_columns(columns)
+                        table_name = sql.Identifier(*audit_table.split('.')).as_string(db.conn)
+                        db.copy_from_stream(io.StringIO(data), table_name, column_list=column_list, commit=False)
+                    db.conn.commit()
+                except Exception:
+                    db.conn.rollback()
+                    channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True, requeue=True)
+                    channel.cancel()
+                    raise
+                ''' acknowledge every message of the batch after the commit '''
+                channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+                self.__remember_loaded(batch_message_ids, max_message_ids)
+                records_loaded += batch_count
+                if verbose:
+                    print(str(records_loaded) + " audit records loaded from " + queue_name)
+                batch = {}
+                batch_count = 0
+                batch_message_ids = set()
+                batch_started = None
+
+            if stopping:
+                break
+
+        channel.cancel()
+        return records_loaded
+
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+        self.connection = None
+        self.channel = None
+        return
+
+
+def get_connection_url(db_credentials, rabbitmq_host):
+    '''
+    amqp url of the rabbitmq entry in database.yaml. CLOUDAMQP_URL environment variable takes precedence
+    '''
+    connect_string = 'amqp://' + db_credentials[rabbitmq_host]['user'] + ':' + \
+                     db_credentials[rabbitmq_host]['password'] + '@' + \
+                     db_credentials[rabbitmq_host]['host'] + ':' + \
+                     str(db_credentials[rabbitmq_host]['port']) + '/' + \
+                     db_credentials[rabbitmq_host]['vhost'] + '/%2f'
+
+    return os.environ.get('CLOUDAMQP_URL', connect_string)
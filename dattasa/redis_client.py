@@ -1,5 +1,7 @@
 import redis
 import csv
+import time
+import zlib
 
 
 class RedisClient():
@@ -33,15 +35,74 @@ class RedisClient():
             print(e, e.args)
         return conn
 
-    def __load_data_from_csv(self, csv_file, file_delimiter, ik, iv):
+    def __load_data_from_csv(self, csv_file, file_delimiter, ik, iv, skip_header=False):
+        '''
+        Generator of (key, value) pairs read from the csv file one row at a time
+        '''
         with open(csv_file) as csvf:
             csv_data = csv.reader(csvf, delimiter=file_delimiter)
-            return [(r[ik], r[iv]) for r in csv_data]
+            if skip_header:
+                next(csv_data, None)
+            for r in csv_data:
+                yield r[ik], r[iv]
 
-    def __store_data(self, conn, data):
-        for i in data:
-            conn.setnx(i[0], i[1])
-        return
+    def __store_data(self, conn, data, batch_size=10000, ttl=None, key_prefix='',
+                     overwrite=False, hash_buckets=0, verbose=False):
+        '''
+        Send the data through a non transactional pipeline in batches of batch_size commands.
+        By default keys are set only if they do not exist (SETNX). In hash mode each key is stored as a field
+        of one of hash_buckets hashes (HSETNX / HSET) which uses a lot less memory for small values
+        :return: number of keys set. Keys that already existed are not counted unless overwrite is set
+        '''
+        pipe = conn.pipeline(transaction=False)
+        buckets = set()
+        row_count = 0
+        keys_set = 0
+        pending = 0
+        start = time.time()
+
+        for key, value in data:
+            if hash_buckets > 0:
+                bucket = _hash_bucket(key, hash_buckets, key_prefix)
+                if overwrite:
+                    pipe.hset(bucket, key, value)
+                else:
+                    pipe.hsetnx(bucket, key, value)
+                if ttl:
+                    buckets.add(bucket)
+            elif overwrite:
+                pipe.set(key_prefix + key, value, ex=ttl)
+            elif ttl:
+                pipe.set(key_prefix + key, value, ex=ttl, nx=True)
+            else:
+                pipe.setnx(key_prefix + key, value)
+
+            pending += 1
+            if pending >= batch_size:
+                keys_set += _count_keys_set(pipe.execute(), overwrite)
+                row_count += pending
+                pending = 0
+                if verbose or self.debug:
+                    elapsed = time.time() - start
+                    print(str(row_count) + " keys sent, " + str(keys_set) + " keys set. " +
+                          str(int(row_count / elapsed if elapsed > 0 else row_count)) + " keys/sec")
+
+        if pending > 0:
+            keys_set += _count_keys_set(pipe.execute(), overwrite)
+            row_count += pending
+
+        if len(buckets) > 0:
+            for bucket in buckets:
+                pipe.expire(bucket, ttl)
+            pipe.execute()
+
+        elapsed = time.time() - start
+        if verbose or self.debug:
+            print("Total " + str(row_count) + " keys sent, " + str(keys_set) + " keys set in " +
+                  str(elapsed * 1000) + " ms. " +
+                  str(int(row_count / elapsed if elapsed > 0 else row_count)) + " keys/sec")
+
+        return keys_set
 
     def clear_redis_data(self, conn, clear_all=False):
         if clear_all:
@@ -57,9 +118,100 @@ class RedisClient():
         else:
             return lookup_value
 
+    def get_redis_data_many(self, conn, lookup_keys, batch_size=1000, missing_value='Not-Found',
+                            as_dict=False, key_prefix='', hash_buckets=0):
+        '''
+        Lookup many keys using one round trip per batch_size keys (MGET, or pipelined HMGET in hash mode)
+        :param conn: redis connection
+        :param lookup_keys: list of keys
+        :param batch_size: number of keys fetched in each round trip
+        :param missing_value: value returned for keys that are not found
+        :param as_dict: return a dictionary of key: value instead of a list
+        :param key_prefix: prefix used while loading the keys (see load_csv_to_redis)
+        :param hash_buckets: number of hash buckets used while loading the keys (see load_csv_to_redis)
+        :return: list of values in the same order as lookup_keys or a dictionary
+        '''
+        lookup_keys = list(lookup_keys)
+        lookup_values = []
+
+        for batch_start in range(0, len(lookup_keys), batch_size):
+            batch_keys = lookup_keys[batch_start:batch_start + batch_size]
+
+            if hash_buckets > 0:
+                bucket_keys = {}
+                for key in batch_keys:
+                    bucket_keys.setdefault(_hash_bucket(key, hash_buckets, key_prefix), []).append(key)
+                pipe = conn.pipeline(transaction=False)
+                bucket_list = list(bucket_keys.keys())
+                for bucket in bucket_list:
+                    pipe.hmget(bucket, bucket_keys[bucket])
+                batch_found = {}
+                for bucket, values in zip(bucket_list, pipe.execute()):
+                    batch_found.update(zip(bucket_keys[bucket], values))
+                batch_values = [batch_found[key] for key in batch_keys]
+            else:
+                batch_values = conn.mget([key_prefix + str(key) for key in batch_keys])
+
+            lookup_values.extend([missing_value if value is None else value for value in batch_values])
+
+        if as_dict:
+            return dict(zip(lookup_keys, lookup_values))
+        return lookup_values
+
+    def map_redis_data(self, conn, lookup_series, batch_size=1000, missing_value='Not-Found',
+                       key_prefix='', hash_buckets=0):
+        '''
+        Lookup every value of a pandas Series (eg:- a dataframe column) in redis.
+        Each distinct value is fetched once using get_redis_data_many
+        df['account_name'] = redis_db.map_redis_data(conn, df['account_id'])
+        :param conn: redis connection
+        :param lookup_series: pandas Series of keys
+        :return: pandas Series of values with the same index as lookup_series
+        '''
+        distinct_keys = list(lookup_series.dropna().unique())
+        lookup_values = self.get_redis_data_many(conn, distinct_keys, batch_size, missing_value,
+                                                 as_dict=True, key_prefix=key_prefix, hash_buckets=hash_buckets)
+        return lookup_series.map(lookup_values).where(lookup_series.notna(), missing_value)
+
     def load_csv_to_redis(self, conn, file_name, key_position,
-                          value_position, csv_delimiter=','):
+                          value_position, csv_delimiter=',', batch_size=10000, ttl=None,
+                          key_prefix='', overwrite=False, hash_buckets=0, skip_header=False, verbose=False):
+        '''
+        Stream a csv file into redis. Rows are read one at a time and written through a pipeline in batches
+        :param conn: redis connection
+        :param file_name:
+        :param key_position: column number of the key (starts from 0)
+        :param value_position: column number of the value (starts from 0)
+        :param csv_delimiter:
+        :param batch_size: number of commands sent in each round trip
+        :param ttl: expire keys (or hash buckets) after ttl seconds
+        :param key_prefix: prefix added to every key (or to the hash bucket name in hash mode)
+        :param overwrite: replace existing keys (SET) instead of keeping them (SETNX)
+        :param hash_buckets: store keys as fields of this many hashes instead of as separate keys
+        :param skip_header: skip the first row of the file
+        :param verbose: print the progress and keys sent per second
+        :return: number of keys set. Keys that already existed are not counted unless overwrite is set
+        '''
         data = self.__load_data_from_csv(file_name, csv_delimiter, key_position,
-                                         value_position)
-        self.__store_data(conn, data)
-        return
+                                         value_position, skip_header)
+        return self.__store_data(conn, data, batch_size, ttl, key_prefix,
+                                 overwrite, hash_buckets, verbose)
+
+
+def _count_keys_set(results, overwrite):
+    '''
+    Number of successful commands in the results of a pipeline. SETNX / HSETNX return a false value for keys
+    that already exist. With overwrite every command sets its key (HSET returns 0 when it replaces a field)
+    '''
+    if overwrite:
+        return len(results)
+    return len([result for result in results if result])
+
+
+def _hash_bucket(key, hash_buckets, key_prefix=''):
+    '''
+    Name of the hash that holds key when keys are stored in hash_buckets hashes
+    '''
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    return key_prefix + str((zlib.crc32(key) & 0xffffffff) % hash_buckets)
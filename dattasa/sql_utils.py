@@ -0,0 +1,217 @@
+import datetime as dt
+import decimal
+
+
+'''
+Helpers shared by the database clients for building sql
+'''
+
+
+def sql_literal(value):
+    '''
+    Return value formatted as a sql literal. Numbers are left as is, everything else is quoted
+    :param value:
+    :return:
+    '''
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, dt.datetime):
+        return "'" + value.strftime("%Y-%m-%d %H:%M:%S.%f") + "'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def output_column_name(column):
+    '''
+    Name of column in the results of a query - drops the table qualifier and the identifier quotes
+    eg:- `t`.`id` and t.id are returned as id
+    :param column:
+    :return:
+    '''
+    return column.strip().split('.')[-1].strip('`"')
+
+
+def split_key_range(min_value, max_value, partitions):
+    '''
+    Split the key range [min_value, max_value] into equal sized ranges.
+    Works for integer, decimal, float, date and datetime keys
+    :param min_value:
+    :param max_value:
+    :param partitions: number of ranges needed
+    :return: list of (lower, upper) tuples. lower is inclusive and upper is exclusive.
+    lower of the first range and upper of the last range are None (unbounded)
+    '''
+    partitions = max(int(partitions), 1)
+    if min_value is None or max_value is None or min_value == max_value or partitions == 1:
+        return [(None, None)]
+
+    if isinstance(min_value, (dt.date, dt.datetime)):
+        step = (max_value - min_value) / partitions
+        if isinstance(min_value, dt.datetime):
+            boundaries = [min_value + step * i for i in range(1, partitions)]
+        else:
+            # date keys are split on whole days
+            boundaries = [min_value + dt.timedelta(days=(step * i).days) for i in range(1, partitions)]
+    elif isinstance(min_value, int) and isinstance(max_value, int):
+        step = (max_value - min_value) // partitions
+        if step == 0:
+            partitions = max_value - min_value
+            step = 1
+        boundaries = [min_value + step * i for i in range(1, partitions)]
+    else:
+        step = (max_value - min_value) / partitions
+        boundaries = [min_value + step * i for i in range(1, partitions)]
+
+    # drop duplicate boundaries that show up for small date ranges
+    unique_boundaries = []
+    for boundary in boundaries:
+        if boundary > min_value and (len(unique_boundaries) == 0 or boundary > unique_boundaries[-1]):
+            unique_boundaries.append(boundary)
+
+    lowers = [None] + unique_boundaries
+    uppers = unique_boundaries + [None]
+    return list(zip(lowers, uppers))
+
+
+def partition_predicates(column, partitions, partition_method='range', min_value=None, max_value=None):
+    '''
+    Return a list of where clause predicates that split a table into partitions using column.
+    range : splits the key range min_value to max_value into equal ranges (numeric or date column)
+    hash  : uses modulo of the column (integer column)
+    Rows where column is null are always part of the first partition
+    :param column:
+    :param partitions:
+    :param partition_method: range or hash
+    :param min_value: needed for range
+    :param max_value: needed for range
+    :return: list of predicates
+    '''
+    predicates = []
+    if partition_method == 'hash':
+        for partition in range(int(partitions)):
+            predicates.append("MOD(ABS({column}), {partitions}) = {partition}".format(
+                column=column, partitions=int(partitions), partition=partition))
+    elif partition_method == 'range':
+        for lower, upper in split_key_range(min_value, max_value, partitions):
+            conditions = []
+            if lower is not None:
+                conditions.append(column + " >= " + sql_literal(lower))
+            if upper is not None:
+                conditions.append(column + " < " + sql_literal(upper))
+            if len(conditions) == 0:
+                conditions.append("1 = 1")
+            predicates.append(" AND ".join(conditions))
+    else:
+        raise Exception('partition_method must be range or hash')
+
+    predicates[0] = "(" + predicates[0] + ") OR " + column + " IS NULL"
+
+    return predicates
+
+
+def select_sql(table, columns='*', conditions=[]):
+    '''
+    SELECT columns FROM table WHERE all the conditions hold. Conditions that are None are skipped
+    :param table:
+    :param columns:
+    :param conditions: list of where clause conditions
+    :return:
+    '''
+    conditions = ["(" + condition + ")" for condition in conditions if condition is not None]
+    if len(conditions) == 0:
+        return "SELECT " + columns + " FROM " + table
+    return "SELECT " + columns + " FROM " + table + " WHERE " + " AND ".join(conditions)
+
+
+def split_sql_statements(sql, dialect='postgres'):
+    '''
+    Split a sql script into individual statements on semicolons that are not inside quotes,
+    dollar quoted strings or comments. Comments are removed and empty statements are skipped
+    :param sql:
+    :param dialect: postgres or mysql. mysql scripts also have backtick quoted identifiers, # comments and
+    backslash escapes in strings, and do not have dollar quoted strings or nested comments
+    :return: list of statements without the trailing semicolon
+    '''
+    mysql = dialect == 'mysql'
+    statements = []
+    current = []
+    position = 0
+    length = len(sql)
+
+    while position < length:
+        char = sql[position]
+        next_char = sql[position + 1] if position + 1 < length else ''
+
+        if (char == '-' and next_char == '-') or (mysql and char == '#'):
+            ''' line comment '''
+            end = sql.find('\n', position)
+            position = length if end < 0 else end
+            current.append(' ')
+        elif char == '/' and next_char == '*':
+            ''' block comment - postgres allows nested block comments '''
+            depth = 1
+            position += 2
+            while position < length and depth > 0:
+                if sql.startswith('/*', position) and not mysql:
+                    depth += 1
+                    position += 2
+                elif sql.startswith('*/', position):
+                    depth -= 1
+                    position += 2
+                else:
+                    position += 1
+            current.append(' ')
+        elif char in ("'", '"') or (mysql and char == '`'):
+            ''' quoted string or identifier. quotes are escaped by doubling them, E'' strings also use backslash '''
+            if mysql:
+                backslash_escapes = char != '`'
+            else:
+                backslash_escapes = char == "'" and position > 0 and sql[position - 1] in ('E', 'e') and \
+                    (position < 2 or not (sql[position - 2].isalnum() or sql[position - 2] == '_'))
+            end = position + 1
+            while end < length:
+                if backslash_escapes and sql[end] == '\\':
+                    end += 2
+                    continue
+                if sql[end] == char:
+                    if end + 1 < length and sql[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            current.append(sql[position:end + 1])
+            position = end + 1
+        elif char == '$' and not mysql:
+            ''' dollar quoted string $tag$ ... $tag$ '''
+            tag_end = position + 1
+            while tag_end < length and (sql[tag_end].isalnum() or sql[tag_end] == '_'):
+                tag_end += 1
+            is_tag = tag_end < length and sql[tag_end] == '$' and not sql[position + 1:tag_end][:1].isdigit()
+            previous = sql[position - 1] if position > 0 else ''
+            if is_tag and not (previous.isalnum() or previous == '_'):
+                tag = sql[position:tag_end + 1]
+                end = sql.find(tag, tag_end + 1)
+                end = length if end < 0 else end + len(tag)
+                current.append(sql[position:end])
+                position = end
+            else:
+                current.append(char)
+                position += 1
+        elif char == ';':
+            statement = ''.join(current).strip()
+            if statement != '':
+                statements.append(statement)
+            current = []
+            position += 1
+        else:
+            current.append(char)
+            position += 1
+
+    statement = ''.join(current).strip()
+    if statement != '':
+        statements.append(statement)
+
+    return statements